@@ -1,49 +1,12 @@
 
-import serial
-from serial.tools import list_ports
-import time, struct, code
+import time, struct
 import argparse
+import contextlib
 import datetime
+import json
 import math
-import re
-
-import requests
-
-data_matrix = [
-    [0x00, 0x00, 0x02],
-    [0x00, 0x02, 0x02],
-    [0x00, 0x04, 0x05],
-    [0x00, 0x0D, 0x04],
-    [0x00, 0x11, 0x04],
-    [0x00, 0x15, 0x04],
-    [0x00, 0x19, 0x04],
-    [0x00, 0x23, 0x14],
-    [0x00, 0x37, 0x04],
-    [0x00, 0x69, 0x02],
-    [0x00, 0x7B, 0x01],
-    [0x40, 0x00, 0x04],
-    [0x40, 0x0A, 0x0A],
-    [0x40, 0x14, 0x02],
-    [0x40, 0x16, 0x02],
-    [0x40, 0x19, 0x02], # New - 20 Aug
-    [0x40, 0x1B, 0x02], 
-    [0x40, 0x1D, 0x02], # New - 20 Aug
-    [0x40, 0x1F, 0x02], # New - 20 Aug
-    [0x60, 0x00, 0x02],
-    [0x60, 0x02, 0x02],
-    [0x60, 0x04, 0x04],
-    [0x60, 0x08, 0x04],
-    [0x60, 0x0C, 0x02], # New - 20 Aug
-    [0x90, 0x00, 0x3A], # 338 byte RAM chunk. Grab every 58 bytes
-    [0x90, 0x3A, 0x3A], # RAM chunk
-    [0x90, 0x74, 0x3A], # RAM chunk
-    [0x90, 0xAE, 0x3A], # RAM chunk
-    [0x90, 0xE8, 0x3A], # RAM chunk
-    [0x91, 0x22, 0x30], # RAM chunk. Grab last 48 bytes
-    [0x91, 0x52, 0x00], # Always empty. Maybe marks end of RAM chunk
-    [0xA0, 0x00, 0x06]
-]
-
+import sys
+from typing import NamedTuple
 
 # label, addr, len, type 
 #   uint - unsigned integer
@@ -241,10 +204,592 @@ data_id = [
 ]
 
 
+class Register(NamedTuple):
+    """ One row of data_id. 'id' is its index in data_id """
+    id: int
+    addr: int
+    length: int
+    type: str
+    label: str
+
+
+class RegisterMap:
+    """
+    Index of a register table (data_id) by address and by id, plus the
+    chunked read plan used for the dummy refresh read.
+
+    The plan is derived from the table: registers outside 'bulk_regions' are
+    read one at a time, registers inside a bulk region are merged into reads
+    of at most that region's maximum length without splitting a register.
+    'extra_reads' are (addr, length) reads with no entry in the table that
+    are added to the plan as they are.
+
+    Overlapping registers raise ValueError. Gaps between registers in the
+    same 0x?000 bank are recorded in 'gaps' as (addr, length).
+    """
+    def __init__(self, table, bulk_regions=(), extra_reads=()):
+        self.registers = [Register(i, *row) for i, row in enumerate(table)]
+        self.bulk_regions = list(bulk_regions)
+        self.by_addr = {}
+        self.byte_index = {} # every byte address -> Register containing it
+        for reg in self.registers:
+            if reg.addr in self.by_addr:
+                raise ValueError(f"Duplicate register 0x{reg.addr:04X} (ids {self.by_addr[reg.addr].id}, {reg.id})")
+            self.by_addr[reg.addr] = reg
+            for a in range(reg.addr, reg.addr + reg.length):
+                if a in self.byte_index:
+                    raise ValueError(f"Register 0x{reg.addr:04X} (id {reg.id}) overlaps "
+                                     f"0x{self.byte_index[a].addr:04X} (id {self.byte_index[a].id})")
+                self.byte_index[a] = reg
+
+        self.gaps = []
+        ordered = sorted(self.registers, key=lambda r: r.addr)
+        for prev, reg in zip(ordered, ordered[1:]):
+            end = prev.addr + prev.length
+            if (reg.addr > end) and ((reg.addr & 0xF000) == (prev.addr & 0xF000)):
+                self.gaps.append((end, reg.addr - end))
+
+        self.read_plan = sorted(self.plan(ordered) + [tuple(r) for r in extra_reads])
+
+    def __getitem__(self, id):
+        return self.registers[id]
+
+    def __len__(self):
+        return len(self.registers)
+
+    def region(self, addr):
+        """ Return the (start, end, max_len) bulk region containing addr, or None """
+        for r in self.bulk_regions:
+            if r[0] <= addr < r[1]:
+                return r
+        return None
+
+    def plan(self, registers):
+        """
+        Return the list of (addr, length) reads that cover 'registers'
+        (sorted by address)
+        """
+        reads = []
+        chunk = None # [addr, length, region]
+        for reg in registers:
+            region = self.region(reg.addr)
+            if ( chunk and region and chunk[2] == region
+                    and (reg.addr + reg.length - chunk[0]) <= region[2] ):
+                chunk[1] = reg.addr + reg.length - chunk[0]
+                continue
+            if chunk:
+                reads.append((chunk[0], chunk[1]))
+            if region and reg.length > region[2]:
+                raise ValueError(f"Register 0x{reg.addr:04X} is longer than the max read of its region")
+            chunk = [reg.addr, reg.length, region]
+        if chunk:
+            reads.append((chunk[0], chunk[1]))
+        return reads
+
+    def plan_for(self, ids):
+        """ Return the reads of 'read_plan' that contain any of the registers in 'ids' """
+        wanted = [self.registers[i] for i in ids]
+        return [(addr, length) for addr, length in self.read_plan
+                if any(addr <= r.addr < addr + length for r in wanted)]
+
+    def find(self, addr):
+        """ Return the Register containing byte address 'addr', or None """
+        return self.byte_index.get(addr)
+
+    def split(self, addr, payload):
+        """
+        Split the payload of a read starting at 'addr' into
+        [(Register, bytes)] for every register it contains completely
+        """
+        out = []
+        end = addr + len(payload)
+        a = addr
+        while a < end:
+            reg = self.byte_index.get(a)
+            if reg is None:
+                a += 1
+            elif (reg.addr >= addr) and (reg.addr + reg.length <= end):
+                out.append((reg, bytes(payload[reg.addr - addr:reg.addr - addr + reg.length])))
+                a = reg.addr + reg.length
+            else:
+                a = reg.addr + reg.length
+        return out
+
+
+register_map = RegisterMap(
+    data_id,
+    bulk_regions=[
+        # 338 byte RAM chunk, max read of 58 bytes
+        (0x9000, 0x9152, 0x3A),
+    ],
+    extra_reads=[
+        (0x9152, 0x00), # Always empty. Maybe marks end of RAM chunk
+        (0xA000, 0x06),
+    ])
+
+# [addr_h, addr_l, len] of every read in the plan. Used to do a dummy read of
+# all registers, which makes sure the 0x9000 data is up to date
+data_matrix = [[addr >> 8, addr & 0xFF, length] for addr, length in register_map.read_plan]
+
+
+def calculate_temperature(adc_value):
+    """
+    Convert an ADC reading into a temperature estimate.
+
+    The constants used here are only estimated.
+    """
+    R1 = 10e3  # 10k ohm
+    R2 = 20e3  # 20k ohm
+    T1 = 50    # 50°C
+    T2 = 35    # 35°C
+
+    adc1 = 0x0180
+    adc2 = 0x022E
+    
+    m = (T2 - T1) / (R2 - R1)
+    b = T1 - m * R1
+
+    resistance = R1 + (adc_value - adc1) * (R2 - R1) / (adc2 - adc1)
+    temperature = m * resistance + b
+
+    return round(temperature, 2)
+
+
+def bytes2dt(time_bytes):
+    epoch_time = int.from_bytes(time_bytes, 'big')
+    dt = datetime.datetime.fromtimestamp(epoch_time, tz=datetime.UTC)
+    return dt
+
+
+def decode_value(type, data):
+    """
+    Decode the raw bytes of a register according to its data_id type.
+    Returns the value given by read_id(output="array")
+    """
+    match type:
+        case "uint":
+            return int.from_bytes(data, 'big')
+        case "date":
+            return bytes2dt(data)
+        case "hhmmss":
+            dur = int.from_bytes(data, 'big')
+            mm, ss = divmod(dur, 60)
+            hh, mm = divmod(mm, 60)
+            return f"{hh}:{mm:02d}:{ss:02d}"
+        case "ascii":
+            str = bytes(data).decode('utf-8')
+            return f'\"{str}\"'
+        case "sn":
+            btype = int.from_bytes(data[0:2],'big')
+            serial = int.from_bytes(data[2:5],'big')
+            return f"Type: {btype:3d}, Serial: {serial:d}"
+        case "adc_t":
+            return calculate_temperature(int.from_bytes(data, 'big'))
+        case "dec_t":
+            temp = data[0] + data[1]/256
+            return f"{temp:.2f}"
+        case "cell_v":
+            return [int.from_bytes(data[i:i+2], 'big') for i in range(0, 10, 2)]
+    raise ValueError(f"Unknown register type '{type}'")
+
+
+# Battery type (first 2 bytes of 0x0004) -> [capacity (Ah), description]
+bat_lookup = {
+    "36": [1.5, "1.5Ah CP (5s1p 18650)"],
+    "37": [2, "2Ah CP (5s1p 18650)"],
+    "38": [3, "3Ah XC (5s2p 18650)"],
+    "39": [4, "4Ah XC (5s2p 18650)"],
+    "40": [5, "5Ah XC (5s2p 18650) (<= May 2019)"],
+    "165": [5, "5Ah XC (5s2p 18650) (Unknnown - Jan 2021)"],
+    "306": [5, "5Ah XC (5s2p 18650) (>= Feb 2021)"],                
+    "424": [5, "5Ah Resistant (5s2p 18650)"],
+    "46": [6, "6Ah XC (5s2p 18650)"],
+    "47": [9, "9Ah HD (5s3p 18650)"],                
+    "104": [3, "3Ah HO (5s1p 21700)"],
+    "106": [6, "6Ah HO (5s2p 21700)"],
+    "107": [8, "8Ah HO (5s2p 21700)"],
+    "108": [12, "12Ah HO (5s3p 21700)"],
+    "383": [8, "8Ah Forge (5s2p 21700 tabless)"],
+    "384": [12, "12Ah Forge (5s3p 21700 tabless)"]
+}
+
+
+class Reading(NamedTuple):
+    """ One register as yielded by M18.read_id_iter() """
+    id: int                 # index in data_id
+    addr: int
+    type: str
+    value: object           # as in read_id(output="array"), None if not read
+    raw: bytes              # payload, None if there was no valid response
+    time: datetime.datetime # when the response arrived
+
+
+class HealthRecord(NamedTuple):
+    """
+    Summary of a battery's health, as printed by M18.health().
+    Times are in seconds, voltages in mV unless stated otherwise.
+    Fields are None if the register(s) they come from were not read.
+    """
+    bat_type: int
+    bat_text: str
+    capacity: float                # Ah, 0 if battery type is unknown
+    e_serial: int
+    system_date: datetime.datetime # battery's clock (0x0037)
+    manufacture_date: datetime.datetime
+    days_since_first_charge: int
+    days_since_tool_use: int
+    days_since_charge: int
+    cell_voltages: list
+    pack_voltage: float            # V
+    imbalance: int
+    temperature: float             # non-Forge
+    temperature_forge: float
+    redlink_charges: int
+    dumb_charges: int
+    total_charges: int
+    charge_time: str               # HH:MM:SS
+    idle_on_charger_time: str      # HH:MM:SS
+    low_voltage_charges: int
+    total_discharge: float         # Ah
+    discharge_cycles: float        # None if battery type is unknown
+    discharged_to_empty: int
+    overheat_events: int
+    overcurrent_events: int
+    low_voltage_events: int
+    low_voltage_bounce: int
+    tool_time: int                 # total time on tool (>10A)
+    discharge_histogram: list      # time @ 10-20A, 20-30A, ..., 200A+
+
+
+def health_record(image):
+    """
+    Calculate a HealthRecord from a register image {addr: bytes}, e.g. from
+    M18.read_image() or a saved snapshot. No battery is needed.
+    """
+    def get(id):
+        reg = register_map[id]
+        data = image.get(reg.addr)
+        if data is None or len(data) < reg.length:
+            return None
+        return decode_value(reg.type, data)
+
+    def days(since):
+        if since is None or bat_now is None:
+            return None
+        return (bat_now - since).days
+
+    sn = image.get(register_map[2].addr)
+    bat_type = int.from_bytes(sn[0:2], 'big') if sn else None
+    e_serial = int.from_bytes(sn[2:5], 'big') if sn else None
+    bat_text = bat_lookup.get(str(bat_type), [0, "Unknown"])
+
+    bat_now = get(8)
+    cells = get(12)
+    temperature_forge = get(18)
+    total_discharge = get(29)
+    histogram = [get(id) for id in range(44, 64)]
+    if None in histogram:
+        histogram = None
+
+    return HealthRecord(
+        bat_type = bat_type,
+        bat_text = bat_text[1],
+        capacity = bat_text[0],
+        e_serial = e_serial,
+        system_date = bat_now,
+        manufacture_date = get(4),
+        days_since_first_charge = get(28),
+        days_since_tool_use = days(get(25)),
+        days_since_charge = days(get(26)),
+        cell_voltages = cells,
+        pack_voltage = sum(cells)/1000 if cells else None,
+        imbalance = max(cells) - min(cells) if cells else None,
+        temperature = get(13),
+        temperature_forge = float(temperature_forge) if temperature_forge is not None else None,
+        redlink_charges = get(33),
+        dumb_charges = get(32),
+        total_charges = get(31),
+        charge_time = get(35),
+        idle_on_charger_time = get(36),
+        low_voltage_charges = get(38),
+        total_discharge = total_discharge/3600 if total_discharge is not None else None,
+        discharge_cycles = (total_discharge/3600/bat_text[0]
+                            if (total_discharge is not None and bat_text[0] != 0) else None),
+        discharged_to_empty = get(39),
+        overheat_events = get(40),
+        overcurrent_events = get(41),
+        low_voltage_events = get(42),
+        low_voltage_bounce = get(43),
+        tool_time = sum(histogram) if histogram else None,
+        discharge_histogram = histogram,
+    )
+
+
+# Registers read by M18.triage(), most likely reason to reject first
+triage_order = [
+    12, # Cell voltages (0x400A)
+    13, # Temperature (non-Forge)
+    18, # Temperature (Forge)
+    40, # Overheat events (0x9032)
+    41, # Overcurrent events (0x9034)
+    38, # Low-voltage charges (0x902E)
+]
+
+# [reason, data_id index, test]. The pack is rejected if test(value) is True.
+# Rules are skipped if their register could not be read
+triage_rules = [
+    ["Cell imbalance > 200mV", 12, lambda cv: max(cv) - min(cv) > 200],
+    ["Cell voltage < 2500mV", 12, lambda cv: min(cv) < 2500],
+    ["Temperature > 60C", 13, lambda t: t > 60],
+    ["Temperature > 60C", 18, lambda t: float(t) > 60],
+    ["Overheated > 10 times", 40, lambda n: n > 10],
+    ["Overcurrent > 20 events", 41, lambda n: n > 20],
+    ["Charged with a cell < 2.5V > 3 times", 38, lambda n: n > 3],
+]
+
+# Registers of which a pack only has one (Forge or non-Forge temperature).
+# Their rules only make the verdict "unknown" if none of them could be read
+triage_alternatives = [
+    [13, 18],
+]
+
+
+class TriageResult(NamedTuple):
+    """ Result of M18.triage() """
+    verdict: str     # "reject", "pass", or "unknown" if a rule's register (or all of
+                     # its triage_alternatives) could not be read
+    reasons: list    # reasons of the rules that rejected the pack
+    values: dict     # data_id index -> value of every register read
+    duration: float  # seconds
+
+
+def print_health(record):
+    """ Print a HealthRecord as the report shown by M18.health() """
+    print(f"Type: {record.bat_type} [{record.bat_text}]")
+    print("E-serial:", record.e_serial, "(does NOT match case serial)")
+    
+    if record.manufacture_date is not None:
+        print("Manufacture date:", record.manufacture_date.strftime('%Y-%m-%d') )
+    else:
+        print("Manufacture date:", None )
+    print("Days since 1st charge:", record.days_since_first_charge)
+    print("Days since last tool use:", record.days_since_tool_use )
+    print("Days since last charge:", record.days_since_charge )
+    print("Pack voltage:", record.pack_voltage )
+    print("Cell Voltages (mV):", record.cell_voltages )
+    print("Cell Imbalance (mV):", record.imbalance )
+    if( record.temperature ):
+        print("Temperature (deg C):", record.temperature)
+    if( record.temperature_forge is not None ):
+        print("Temperature (deg C):", f"{record.temperature_forge:.2f}")
+    
+    print("\nCHARGING STATS:")
+    print(f"Charge count [Redlink, dumb, (total)]: {record.redlink_charges}, {record.dumb_charges}, ({record.total_charges})")
+    print("Total charge time:", record.charge_time)
+    print("Time idling on charger:", record.idle_on_charger_time)
+    print("Low-voltage charges (any cell <2.5V):", record.low_voltage_charges)
+    
+    print("\nTOOL USE STATS:")
+    if record.total_discharge is not None:
+        print("Total discharge (Ah):", f"{record.total_discharge:.2f}")
+    else:
+        print("Total discharge (Ah):", None)
+    if record.discharge_cycles is not None:
+        total_discharge_cycles = f"{record.discharge_cycles:.2f}"
+    else:
+        total_discharge_cycles = 'Unknown battery type, unable to calculate'
+    print("Total discharge cycles:", total_discharge_cycles)
+    print("Times discharged to empty:", record.discharged_to_empty)
+    print("Times overheated:", record.overheat_events)
+    print("Overcurrent events:", record.overcurrent_events)
+    print("Low-voltage events:", record.low_voltage_events)
+    print("Low-voltage bounce/stutter:", record.low_voltage_bounce)
+    
+    tool_time = record.tool_time
+    if tool_time is None or record.discharge_histogram is None:
+        print("Total time on tool (>10A):", None)
+        return
+    print("Total time on tool (>10A):", datetime.timedelta(seconds=tool_time))
+        
+    for i, t in enumerate(record.discharge_histogram):
+        if i < 19:
+            amp_range = f"{(i+1)*10}-{(i+2)*10}A"
+        else:
+            # Do last label different
+            amp_range = f"> 200A"
+        label = f"Time @ {amp_range:>8}:"
+        hhmmss = datetime.timedelta(seconds=t)
+        # A new or unused pack has no time on tool
+        pct = round( (t/tool_time)*100 ) if tool_time else 0
+        bar = "X" * round(pct)
+        print(label, hhmmss, f"{pct:2d}%", bar)
+
+
+def record_json(record):
+    """ Convert a HealthRecord (or any NamedTuple) into a dict json can serialise """
+    return {k: json_value(v) for k, v in record._asdict().items()}
+
+
+def image_to_json(image):
+    """ {addr: bytes} -> {"0x9000": "hex"} """
+    return {f"0x{addr:04X}": bytes(data).hex() for addr, data in sorted(image.items())}
+
+
+def image_from_json(obj):
+    """ {"0x9000": "hex"} -> {addr: bytes} """
+    return {int(addr, 16): bytes.fromhex(data) for addr, data in obj.items()}
+
+
+class RegisterChange(NamedTuple):
+    id: int
+    addr: int
+    type: str
+    label: str
+    old: object     # decoded as in read_id(output="array")
+    new: object
+    delta: object   # new - old for numbers, cell voltages and dates, else None
+
+
+def register_delta(type, old, new):
+    """ Difference between two raw values of a register, or None if it has no meaning """
+    match type:
+        case "uint" | "hhmmss":
+            return int.from_bytes(new, 'big') - int.from_bytes(old, 'big')
+        case "date":
+            return datetime.timedelta(seconds=int.from_bytes(new, 'big') - int.from_bytes(old, 'big'))
+        case "cell_v":
+            return [b - a for a, b in zip(decode_value(type, old), decode_value(type, new))]
+        case "adc_t" | "dec_t":
+            return round(float(decode_value(type, new)) - float(decode_value(type, old)), 2)
+    return None
+
+
+def diff_images(old, new):
+    """
+    Compare two register images {addr: bytes}, e.g. a saved snapshot and
+    a fresh read. Returns [RegisterChange] in data_id order. Registers
+    missing from either image are ignored.
+    """
+    changes = []
+    if old == new:
+        return changes
+    for reg in register_map.registers:
+        a, b = old.get(reg.addr), new.get(reg.addr)
+        if a is None or b is None or a == b:
+            continue
+        changes.append(RegisterChange(reg.id, reg.addr, reg.type, reg.label.strip(),
+                                      decode_value(reg.type, a), decode_value(reg.type, b),
+                                      register_delta(reg.type, a, b)))
+    return changes
+
+
+def diff_history(images):
+    """
+    Compare each image in a list with the one before it, e.g. every
+    snapshot of one pack in time order. Returns a list of [RegisterChange],
+    one per consecutive pair.
+    """
+    return [diff_images(a, b) for a, b in zip(images, images[1:])]
+
+
+def load_snapshots(path):
+    """
+    Read a snapshot file: one JSON object per line, as written by
+    'm18.py dump' or 'm18.py health'. Yields dicts with "time" as a datetime and
+    "image" as {addr: bytes}. Lines without an image are skipped.
+    """
+    with open(path) as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            snap = json.loads(line)
+            if "image" not in snap:
+                continue
+            snap["image"] = image_from_json(snap["image"])
+            if snap.get("time"):
+                snap["time"] = datetime.datetime.fromisoformat(snap["time"])
+            yield snap
+
+
 
 
 
 
+class FrameParser:
+    """
+    Splits the bytes received from the battery (already bit-reversed) into
+    frames, and resynchronises after stray or corrupted bytes instead of
+    relying on the input buffer being flushed before every command.
+
+    Read responses are [0x81, acc, n, payload (n bytes), checksum (2 bytes)]
+    and errors are the short frame [0x82, code]. Bytes before a header are
+    dropped and counted as 'stray'. A read response with a bad checksum is
+    counted as 'checksum' and only its header byte is dropped, so a real
+    header inside it can still be found. For the same reason a 0x82
+    followed by 0x81 is taken as a stray byte, not as an error frame.
+
+    errors counts:
+        stray     - bytes dropped while looking for a header
+        checksum  - read responses with a bad checksum
+        short     - responses that stopped before the end of the frame
+        stale     - bytes or frames left over from an earlier command
+        error     - 0x82 error frames received
+    """
+    def __init__(self):
+        self.buffer = bytearray()
+        self.errors = {"stray": 0, "checksum": 0, "short": 0, "stale": 0, "error": 0}
+
+    def clear(self):
+        self.buffer.clear()
+
+    def feed(self, data):
+        self.buffer += data
+
+    def needed(self):
+        """ Number of bytes still needed to complete the frame at the head of the buffer """
+        buf = self.buffer
+        if not buf:
+            return 1
+        if buf[0] == 0x82:
+            return max(2 - len(buf), 1)
+        if len(buf) < 3:
+            return 3 - len(buf)
+        return max(buf[2] + 5 - len(buf), 1)
+
+    def next_frame(self):
+        """ Return the next complete, valid frame, or None if more bytes are needed """
+        buf = self.buffer
+        while buf:
+            header = buf[0]
+            if header == 0x82:
+                if len(buf) < 2:
+                    return None
+                if buf[1] == 0x81:
+                    # Stray 0x82 before a read response
+                    self.errors["stray"] += 1
+                    del buf[0]
+                    continue
+                frame = buf[:2]
+                del buf[:2]
+                self.errors["error"] += 1
+                return frame
+            if header == 0x81:
+                if len(buf) < 3 or len(buf) < buf[2] + 5:
+                    return None
+                size = buf[2] + 5
+                frame = buf[:size]
+                if (sum(frame[:-2]) & 0xFFFF) == int.from_bytes(frame[-2:], 'big'):
+                    del buf[:size]
+                    return frame
+                self.errors["checksum"] += 1
+                del buf[0]
+                continue
+            self.errors["stray"] += 1
+            del buf[0]
+        return None
+
+
 def print_debug_bytes(data):
     data_print = " ".join(f"{byte:02X}" for byte in data)
     print(f"DEBUG: ", data_print)
@@ -260,6 +805,62 @@ class M18:
     MAX_CURRENT = 6000
 
     ACC = 4
+
+    # Read commands in flight at once in cmd_iter(). 1 = stop-and-wait.
+    # Pipelining is experimental; try it with m18_sim first
+    PIPELINE_WINDOW = 1
+    pipeline_fallbacks = 0
+
+    # Times cmd() resends a read whose response was lost, corrupted or cut short
+    READ_RETRIES = 1
+    # Silence after which a response that has started is treated as finished
+    INTER_BYTE_TIMEOUT = 0.1
+    rx_discarded = bytearray()
+
+    # Link speed. BAUD always works. With NEGOTIATE_BAUD, reset() tries the
+    # faster BAUD_RATES and remembers what works per battery type (per M18
+    # object, i.e. per adapter, in 'baud_by_type')
+    BAUD = 4800
+    BAUD_RATES = [9600, 19200, 38400]
+    NEGOTIATE_BAUD = False
+    LINK_CHECKS = 3
+    link_baud = None
+
+    # probe() keeps J2 high for less than the 0.48s that counts as a dumb charge
+    PROBE_SETTLE  = 0.3
+    PROBE_TIMEOUT = 0.1
+
+    # Receives observe(port, op, seconds, ok) for every sync ("sync"), read
+    # ("read") and station step, e.g. m18_metrics.Metrics. None = off
+    metrics = None
+
+    # data_id indexes read by health(). The comments give the position in
+    # the returned array
+    HEALTH_REGISTERS = [
+        4,  # 0.  Manufacture date
+        28, # 1.  Days since first charge
+        25, # 2.  Days since last tool use (corrected for current time)
+        26, # 3.  Days since last charge (corrected for current time)
+        12, # 4.  Voltages and imbalance
+        13, # 5.  temp (non-forge)
+        18, # 6.  temp (forge)
+        29, # 7.  Total discharge (Ah)
+        39, # 8.  Discharged to empty (count)
+        40, # 9.  Overheat events
+        41, # 10. Overcurrent events
+        42, # 11. Low-voltage events
+        43, # 12. Low-voltage bounce
+        33, 32, 31, # 13, 14, 15. Redlink, dumb, total charge count
+        35, # 16. Total charge time
+        36, # 17. Time idling on charger
+        38  # 18. Low-voltage charges (any cell <2.5V)
+    ] 
+    HEALTH_REGISTERS += range(44,64) # 19-38. discharge buckets (10-20A, 20-30A, ..., 200A+)
+    HEALTH_REGISTERS += [
+        8,  # 39. System date
+        2   # 40. type & serial
+    ]
+
     
     PRINT_TX = False
     PRINT_RX = False
@@ -283,6 +884,23 @@ class M18:
             
 
     def __init__(self, port):
+        """
+        'port' is the name of a serial port, None to choose from a menu, or
+        an already open serial-like object (e.g. m18_sim.SimulatedBattery)
+        """
+        self.rx = FrameParser()
+        self.baud_by_type = {}
+        if (port is not None) and not isinstance(port, str):
+            self.port = port
+            self.name = getattr(port, 'port', None) or type(port).__name__
+            self.idle()
+            return
+
+        # pyserial is imported here so the CLI can parse arguments and emit
+        # errors without paying for it
+        import serial
+        from serial.tools import list_ports
+
         if( port is None ):
             print("*** NO PORT SPECIFIED ***")
             print("Available serial ports (choose one that says USB somewhere):")
@@ -309,10 +927,42 @@ class M18:
             port = p.device
             
             
-        self.port = serial.Serial(port, baudrate=4800, timeout=0.8, stopbits=2)
+        self.port = serial.Serial(port, baudrate=self.BAUD, timeout=0.8, stopbits=2)
+        self.name = port
         self.idle()
 
+    def observe(self, op, start, ok):
+        """ Report an operation that started at time.monotonic() 'start' to 'metrics' """
+        if self.metrics is not None:
+            self.metrics.observe(self.name, op, time.monotonic() - start, ok)
+
     def reset(self):
+        """
+        Reset the connected device and synchronise with it. See sync().
+
+        If NEGOTIATE_BAUD is set, the link is run at the fastest rate found
+        by negotiate_baud(). The rate is kept for later resets and
+        negotiated again if the battery stops responding at it.
+
+        Returns:
+            bool: True if the device responded with the expected sync byte,
+                False otherwise.
+        """
+        start = time.monotonic()
+        if not self.NEGOTIATE_BAUD:
+            ok = self.sync()
+        else:
+            ok = False
+            if self.link_baud == self.BAUD:
+                ok = self.sync()
+            elif self.link_baud is not None:
+                ok = self.try_sync(self.link_baud)
+            if not ok:
+                ok = self.negotiate_baud() is not None
+        self.observe("sync", start, ok)
+        return ok
+
+    def sync(self):
         """
         Reset the connected device via the serial port.
 
@@ -326,6 +976,7 @@ class M18:
                 False otherwise.
         """
         self.ACC = 4
+        self.rx.clear()
         self.port.break_condition = True
         self.port.dtr = True
         time.sleep(0.3)
@@ -344,6 +995,99 @@ class M18:
             print(f"Unexpected response: {response}")
             return False
 
+    def negotiate_baud(self):
+        """
+        Find the fastest rate in BAUD_RATES that works with this battery.
+
+        The battery type is read at BAUD first. Each faster rate is tried
+        (fastest first) with try_sync() followed by LINK_CHECKS reads of the
+        type & serial register, which must all be valid and match the read
+        at BAUD. try_sync() gives up quickly, so a rate the battery does not
+        support doesn't count as a dumb charge. The result is remembered per battery type in
+        'baud_by_type', so later packs of the same type skip the search.
+
+        Leaves the link synchronised at the chosen rate. If the type can't
+        be read at BAUD the link stays at BAUD.
+
+        Returns:
+            int: the chosen baudrate, or None if the battery did not respond
+        """
+        self.link_baud = None
+        self.port.baudrate = self.BAUD
+        if not self.sync():
+            return None
+        try:
+            reference = self.cmd(0x00, 0x04, 5, 10)
+        except ValueError:
+            reference = None
+        if not self.verify_response(reference, 5):
+            # Don't try faster rates without a reference to check them against
+            self.link_baud = self.BAUD
+            return self.BAUD if self.sync() else None
+        bat_type = int.from_bytes(reference[3:5], 'big')
+
+        if bat_type in self.baud_by_type:
+            candidates = [self.baud_by_type[bat_type]]
+        else:
+            candidates = sorted(self.BAUD_RATES, reverse=True)
+
+        chosen = self.BAUD
+        tried = False
+        for baud in candidates:
+            if baud <= self.BAUD:
+                break
+            tried = True
+            if self.try_sync(baud) and all(self.link_check(reference) for _ in range(self.LINK_CHECKS)):
+                chosen = baud
+                break
+
+        self.baud_by_type[bat_type] = chosen
+        self.link_baud = chosen
+        self.port.baudrate = chosen
+        if tried and chosen == self.BAUD:
+            # Battery may be left locked on to a failed rate
+            self.sync()
+        return chosen
+
+    def try_sync(self, baud):
+        """
+        sync() at 'baud', but like probe() only wait PROBE_TIMEOUT for the
+        reply and return J2 to idle if there is none. J2 is then high for
+        less than the 0.48s that counts as a dumb charge (0x901E).
+
+        Returns:
+            bool: True if the battery replied; the link is then synchronised
+                at 'baud'
+        """
+        self.ACC = 4
+        self.rx.clear()
+        timeout = self.port.timeout
+        self.port.baudrate = baud
+        self.idle()
+        time.sleep(0.3)
+        response = b""
+        try:
+            self.port.timeout = self.PROBE_TIMEOUT
+            self.high()
+            time.sleep(self.PROBE_SETTLE)
+            self.send(struct.pack('>B', self.SYNC_BYTE))
+            response = self.port.read(1)
+        finally:
+            self.port.timeout = timeout
+        if len(response) == 1 and self.reverse_bits(response[0]) == self.SYNC_BYTE:
+            time.sleep(0.01)
+            return True
+        self.idle()
+        return False
+
+    def link_check(self, reference):
+        """ Read type & serial (0x0004) and check it matches 'reference' """
+        try:
+            response = self.cmd(0x00, 0x04, 5, 10)
+        except ValueError:
+            return False
+        return self.verify_response(response, 5) and response[3:8] == reference[3:8]
+
     def update_acc(self):
         acc_values = [0x04, 0x0C, 0x1C]
         current_index = acc_values.index(self.ACC)
@@ -363,16 +1107,17 @@ class M18:
         lsb_command += struct.pack(">H", self.checksum(lsb_command)) 
         return lsb_command
     
-    def send(self, command):
-        self.port.reset_input_buffer()
+    def send(self, command, flush = True):
+        if flush:
+            self.port.reset_input_buffer()
         debug_print = " ".join(f"{byte:02X}" for byte in command)
         msb = bytearray(self.reverse_bits(byte) for byte in command)
         if self.PRINT_TX:
             print(f"Sending:  {debug_print}")
         self.port.write(msb)
     
-    def send_command(self, command):
-        self.send(self.add_checksum(command))
+    def send_command(self, command, flush = True):
+        self.send(self.add_checksum(command), flush)
 
     def read_response(self, size):
         msb_response = self.port.read(1)
@@ -433,8 +1178,10 @@ class M18:
         self.txrx_restore() # restore TX/RX print status
     
 
-    def simulate_for(self, duration):
+    def simulate_for(self, duration, record=None):
         # Simulate charging for 'time' seconds
+        # record: optional m18_series.SeriesWriter with 4 channels, gets the
+        # payload bytes of every keepalive response
         print(f"Simulating charger communication for {duration} seconds...")
         begin_time = time.time()
         self.reset()
@@ -448,7 +1195,9 @@ class M18:
             #start_time = time.time()
             while (time.time() - begin_time) < duration:
                 time.sleep(0.5)
-                self.keepalive()
+                response = self.keepalive()
+                if record is not None and len(response) == 9:
+                    record.append(datetime.datetime.now(), list(response[3:7]))
         except KeyboardInterrupt:
             print("\nSimulation aborted by user. Exiting gracefully...")
         finally:
@@ -468,8 +1217,23 @@ class M18:
         data = self.cmd(a,b,c,length)
         data_print = " ".join(f"{byte:02X}" for byte in data)
         print(f"Response from: 0x{(a * 0x100 + b):04X}:", data_print)
+        self.print_registers(a * 0x100 + b, data, c)
         self.idle()
         self.PRINT_RX = rx_debug
+
+    def print_registers(self, addr, response, length):
+        """
+        Print the known data_id registers contained in a read response of
+        'length' bytes from 'addr'
+        """
+        if not ( response and len(response) >= 4 and response[0] == 0x81 ):
+            return
+        for reg, data in register_map.split(addr, response[3:3 + length]):
+            try:
+                value = decode_value(reg.type, data)
+            except Exception:
+                value = "------"
+            print(f"  {reg.id:3d} 0x{reg.addr:04X} {reg.label.strip():<39} {json_value(value)}")
         
     def try_cmd(self, cmd, msb, lsb, len, ret_len=0 ):
         # Turn off TX/RX printing, restore after printing
@@ -484,23 +1248,190 @@ class M18:
         data = self.read_response(ret_len)
         data_print = " ".join(f"{byte:02X}" for byte in data)
         print(f"Response from: 0x{(msb * 0x100 + lsb):04X}:", data_print)
+        self.print_registers(msb * 0x100 + lsb, data, len)
         self.idle()
         self.txrx_restore()
         
     
+    def discard_stale(self):
+        """ Drop anything received since the last response, counting it as stale """
+        if self.rx.buffer:
+            self.rx.errors["stale"] += len(self.rx.buffer)
+            self.rx.clear()
+        waiting = self.port.in_waiting
+        if waiting:
+            self.rx.errors["stale"] += len(self.port.read(waiting))
+
+    def read_frame(self, length):
+        """
+        Read the response to a read command with a 'length' byte payload
+        through the frame parser (self.rx). Stray bytes, corrupted frames and
+        frames of the wrong length are skipped.
+
+        Returns:
+            The 0x81 response or 0x82 error frame, or None if bytes were
+            received but no valid frame (they are left in 'rx_discarded')
+        Raises:
+            ValueError if nothing was received
+        """
+        rx = self.rx
+        checksum_errors = rx.errors["checksum"]
+        received = bytearray()
+        timeout = self.port.timeout
+        timed_out = False
+        try:
+            while True:
+                frame = rx.next_frame()
+                if frame is not None:
+                    if frame[0] == 0x81 and frame[2] != length:
+                        rx.errors["stale"] += 1
+                        continue
+                    if self.PRINT_RX:
+                        print(f"Received: {' '.join(f'{byte:02X}' for byte in frame)}")
+                    return frame
+                if timed_out:
+                    if not rx.buffer:
+                        break
+                    # The frame at the head never completed. Its header may
+                    # have been a stray byte, so drop it and look for a frame
+                    # in the bytes after it
+                    rx.errors["short"] += 1
+                    del rx.buffer[0]
+                    continue
+                if rx.errors["checksum"] > checksum_errors and not rx.buffer:
+                    # The whole response was corrupted; no point waiting for the timeout
+                    break
+                msb = self.port.read(rx.needed())
+                if not msb:
+                    timed_out = True
+                    continue
+                lsb = bytearray(self.reverse_bits(byte) for byte in msb)
+                received += lsb
+                rx.feed(lsb)
+                # The battery sends a frame without gaps. Once it has started,
+                # a short silence means the rest of it is not coming
+                self.port.timeout = self.INTER_BYTE_TIMEOUT
+        finally:
+            self.port.timeout = timeout
+
+        if not received:
+            raise ValueError("Empty response")
+        self.rx_discarded = received
+        if self.PRINT_RX:
+            print(f"Received (invalid): {' '.join(f'{byte:02X}' for byte in received)}")
+        return None
+
     def cmd(self, a,b,c,length, command = 0x01):
-        self.send_command(struct.pack('>BBBBBB', command, 0x04, 0x03, a, b, c))
-        return self.read_response(length)
-        
+        if length != c + 5:
+            # Not a normal read response, don't try to frame it
+            self.send_command(struct.pack('>BBBBBB', command, 0x04, 0x03, a, b, c))
+            return self.read_response(length)
+        start = time.monotonic()
+        for attempt in range(self.READ_RETRIES + 1):
+            self.discard_stale()
+            self.send_command(struct.pack('>BBBBBB', command, 0x04, 0x03, a, b, c), flush = False)
+            try:
+                response = self.read_frame(c)
+            except ValueError:
+                # Nothing received. The command or the response may have been lost
+                if attempt < self.READ_RETRIES:
+                    continue
+                self.observe("read", start, False)
+                raise
+            if response is not None:
+                self.observe("read", start, True)
+                return response
+        # Give callers the bytes that arrived, as read_response() would
+        self.observe("read", start, False)
+        return self.rx_discarded
+
+    def verify_response(self, response, length):
+        """ True if 'response' is a complete 0x81 read response of 'length' bytes with a valid checksum """
+        return ( response is not None and len(response) == length + 5 and response[0] == 0x81
+                 and self.checksum(response[:-2]) == int.from_bytes(response[-2:], 'big') )
+
+    def drain(self, quiet = 0.1):
+        """ Discard received bytes until the battery has been quiet for 'quiet' seconds """
+        timeout = self.port.timeout
+        self.port.timeout = quiet
+        try:
+            while self.port.read(256):
+                pass
+        finally:
+            self.port.timeout = timeout
+
+    def cmd_iter(self, reads, window = None, command = 0x01):
+        """
+        Send read commands for 'reads' ([addr_h, addr_l, len]) and yield the
+        responses in order, as cmd() would return them.
+
+        With 'window' > 1 (default PIPELINE_WINDOW) the reads are sent in
+        batches of 'window' commands without waiting for each response, so
+        the line is not idle while the battery turns around.
+
+        A response carries no address, so if one is lost the ones after it
+        would be taken for the wrong registers. The responses of a batch are
+        therefore only yielded once all of them have arrived and passed
+        verify_response(); as no other commands are outstanding, a lost
+        response shows up as a timeout at the end of its batch. If anything
+        in a batch is missing or wrong, the outstanding responses are
+        drained and that batch is done again stop-and-wait (counted in
+        'pipeline_fallbacks').
+        """
+        if window is None:
+            window = self.PIPELINE_WINDOW
+        reads = list(reads)
+        if window <= 1:
+            for a, b, c in reads:
+                yield self.cmd(a, b, c, c + 5, command)
+            return
+
+        for first in range(0, len(reads), window):
+            batch = reads[first:first + window]
+            self.discard_stale()
+            for a, b, c in batch:
+                self.send_command(struct.pack('>BBBBBB', command, 0x04, 0x03, a, b, c), flush = False)
+
+            # Any framing error may also mean a response was lost
+            errors = sum(self.rx.errors.values()) - self.rx.errors["error"]
+            responses = []  # (response, seconds)
+            for a, b, c in batch:
+                start = time.monotonic()
+                try:
+                    response = self.read_frame(c)
+                except ValueError:
+                    break
+                if not self.verify_response(response, c):
+                    break
+                responses.append((response, time.monotonic() - start))
+
+            if ( len(responses) == len(batch)
+                    and errors == sum(self.rx.errors.values()) - self.rx.errors["error"] ):
+                for response, seconds in responses:
+                    self.observe("read", time.monotonic() - seconds, True)
+                    yield response
+                continue
+
+            self.pipeline_fallbacks += 1
+            self.drain()
+            self.rx.clear()
+            for a, b, c in batch:
+                yield self.cmd(a, b, c, c + 5, command)
+
 
     def brute(self, a, b, len = 0xFF, command = 0x01):
         self.reset()
+        longest = None
         try:
             for i in range(len):
                 ret = self.cmd(a, b, i, i+5, command)
                 if ret[0] == 0x81:
                     data_print = " ".join(f"{byte:02X}" for byte in ret)
                     print(f"Valid response from: 0x{(a * 0x100 + b):04X} with length: 0x{i:02X}:", data_print)
+                    longest = (ret, i)
+            if longest is not None and command == 0x01:
+                # Decode the known registers once, from the longest valid read
+                self.print_registers(a * 0x100 + b, *longest)
         except KeyboardInterrupt:
             print("\nSimulation aborted by user. Exiting gracefully...")
         finally:
@@ -560,34 +1491,154 @@ class M18:
         time.sleep(duration)
         self.idle()
 
-    def calculate_temperature(self, adc_value):
+    def probe(self):
+        """
+        Check whether a battery is connected, without incrementing the dumb
+        charge counter (0x901E, J2 high for >= 0.48s).
+
+        Same as reset() but J2 is only high for PROBE_SETTLE + PROBE_TIMEOUT
+        and is returned to idle before returning.
+
+        A reply that is not the sync byte is reported to 'metrics' as a
+        failed "probe", which counts towards quarantine like a failed sync.
+        No reply just means no battery and is not reported.
+
+        Returns:
+            bool: True if a battery replied to the sync byte
         """
-        Convert an ADC reading into a temperature estimate.
+        start = time.monotonic()
+        timeout = self.port.timeout
+        baudrate = self.port.baudrate
+        self.port.timeout = self.PROBE_TIMEOUT
+        self.port.baudrate = self.BAUD
+        response = b""
+        try:
+            self.high()
+            time.sleep(self.PROBE_SETTLE)
+            self.send(struct.pack('>B', self.SYNC_BYTE))
+            response = self.port.read(1)
+        finally:
+            self.idle()
+            self.port.timeout = timeout
+            self.port.baudrate = baudrate
+        ok = len(response) == 1 and self.reverse_bits(response[0]) == self.SYNC_BYTE
+        if response:
+            self.observe("probe", start, ok)
+        return ok
 
-        The constants used here are only estimated.
+    def station(self, pipeline=None, interval=1.0, misses=2, packs=0, on_pack=None):
         """
-        R1 = 10e3  # 10k ohm
-        R2 = 20e3  # 20k ohm
-        T1 = 50    # 50°C
-        T2 = 35    # 35°C
+        Run as a resident test station: keep TX idle, probe() for a battery
+        at most once every 'interval' seconds, run 'pipeline' as soon as one
+        responds, wait until it has been removed ('misses' failed probes in
+        a row) and go back to waiting.
 
-        adc1 = 0x0180
-        adc2 = 0x022E
-        
-        m = (T2 - T1) / (R2 - R1)
-        b = T1 - m * R1
+        pipeline - list of (name, function) or functions. Each is called as
+                   function(self) and its result stored under 'name' (or the
+                   function's __name__). Default reads all registers
+        packs    - stop after this many packs (0 = until Ctrl+C)
+        on_pack  - called with {"pack", "time", "duration", "results"} after
+                   each pack. Default prints a summary line
 
-        resistance = R1 + (adc_value - adc1) * (R2 - R1) / (adc2 - adc1)
-        temperature = m * resistance + b
+        With 'metrics' set, each step is reported as an operation of that
+        name and each pack as "pack". The station stops when
+        metrics.quarantined() says this adapter should not be used, also
+        while waiting for a pack. A serial port error while probing is then
+        counted as a failed probe instead of stopping the station.
 
-        return round(temperature, 2)
+        Returns the number of packs processed
+        """
+        if pipeline is None:
+            pipeline = [("registers", lambda m: m.read_id(output="array"))]
+        steps = [s if isinstance(s, tuple) else (s.__name__, s) for s in pipeline]
+        if on_pack is None:
+            on_pack = lambda p: print(f"Pack {p['pack']}: {', '.join(p['results'])} in {p['duration']:.1f}s")
+
+        def probe():
+            start = time.monotonic()
+            try:
+                return self.probe()
+            except OSError as e:
+                if self.metrics is None:
+                    raise
+                print(f"probe: Failed with error: {e}")
+                self.observe("probe", start, False)
+                return False
+
+        def quarantined():
+            if self.metrics is not None and self.metrics.quarantined(self.name):
+                print(f"Adapter {self.name} quarantined: too many sync failures. Check the adapter and cable")
+                return True
+            return False
+
+        count = 0
+        self.idle()
+        try:
+            while True:
+                # Wait for a battery
+                found = probe()
+                while not found and not quarantined():
+                    time.sleep(interval)
+                    found = probe()
+                if not found:
+                    break
+
+                count += 1
+                start = time.time()
+                pack_start = time.monotonic()
+                results = {}
+                failed = False
+                for name, fn in steps:
+                    step_start = time.monotonic()
+                    try:
+                        results[name] = fn(self)
+                        self.observe(name, step_start, True)
+                    except Exception as e:
+                        results[name] = {"error": str(e)}
+                        self.observe(name, step_start, False)
+                        failed = True
+                    finally:
+                        self.idle()
+                self.observe("pack", pack_start, not failed)
+                on_pack({
+                    "pack": count,
+                    "time": datetime.datetime.now(),
+                    "duration": time.time() - start,
+                    "results": results,
+                })
+                if packs and count >= packs:
+                    break
+                if quarantined():
+                    break
+
+                # Wait for it to be removed
+                missed = 0
+                while missed < misses:
+                    time.sleep(interval)
+                    missed = 0 if probe() else missed + 1
+        except KeyboardInterrupt:
+            print("\nStation stopped by user. Exiting gracefully...")
+        finally:
+            self.idle()
+        return count
+
+    def calculate_temperature(self, adc_value):
+        return calculate_temperature(adc_value)
 
     def bytes2dt(self, time_bytes):
-        epoch_time = int.from_bytes(time_bytes, 'big')
-        dt = datetime.datetime.fromtimestamp(epoch_time, tz=datetime.UTC)
-        return dt
+        return bytes2dt(time_bytes)
 
         
+    def refresh(self, plan = None):
+        """
+        Do dummy read of 'plan' ([addr_h, addr_l, len], default data_matrix)
+        to update 0x9000 data. Must be called after reset(); leaves TX idle
+        """
+        for response in self.cmd_iter(data_matrix if plan is None else plan):
+            pass
+        self.idle()
+        time.sleep(0.1)
+
     def read_all(self):
         try:
             self.reset()
@@ -605,6 +1656,40 @@ class M18:
             print(f"read_all: Failed with error: {e}")
     
 
+    def read_id_iter(self, id_array = [], force_refresh=True):
+        """
+        Read data by ID, yielding a Reading for each register as soon as its
+        response arrives. TX is returned to idle when the generator finishes
+        or is closed early.
+        # id_array - array of registers to read. Default is all
+        # force_refresh - force a read of all registers to ensure they're up to date
+        """
+        if ( len(id_array) == 0 ):
+            id_array = range(0,len(data_id))
+        regs = [register_map[i] for i in id_array]
+
+        try:
+            self.reset()
+            if (force_refresh):
+                self.refresh()
+                self.reset()
+
+            reads = [[reg.addr >> 8, reg.addr & 0xFF, reg.length] for reg in regs]
+            for reg, response in zip(regs, self.cmd_iter(reads)):
+                now = datetime.datetime.now()
+                if self.verify_response(response, reg.length):
+                    # extract payload. message without header and cksum
+                    data = bytes(response[3:(3+reg.length)])
+                    try:
+                        value = decode_value(reg.type, data)
+                    except Exception:
+                        value = None
+                    yield Reading(reg.id, reg.addr, reg.type, value, data, now)
+                else:
+                    yield Reading(reg.id, reg.addr, reg.type, None, None, now)
+        finally:
+            self.idle()
+
     def read_id(self, id_array = [], force_refresh=True, output="label"):
         """
         Read data by ID. Default is print all
@@ -616,10 +1701,6 @@ class M18:
         #       "array" - returns array of [id, value]
         #       "form" - returns array of [value]
         """
-        # If empty, default is print all
-        if ( len(id_array) == 0 ):
-            id_array = range(0,len(data_id))
-            
         if not ( (output == "label") or (output == "raw") or (output == "array") or (output == "form")):
             print(f"Unrecognised 'output' = {output}. Please choose \"label\", \"raw\", or \"array\"")
             output = "label"
@@ -627,15 +1708,6 @@ class M18:
         array = []
         
         try:
-            self.reset()
-            
-            if (force_refresh):
-                # Do dummy read to update 0x9000 data
-                for addr_h, addr_l, length in data_matrix:
-                    response = self.cmd(addr_h, addr_l, length, (length + 5))
-                self.idle()
-                time.sleep(0.1)
-            
             # Add date to top
             now = datetime.datetime.now()
             formatted_time = now.strftime("%Y-%m-%d %H:%M:%S")
@@ -647,59 +1719,29 @@ class M18:
             elif ( output == "form" ):
                 array.append(formatted_time)
             
-            
-            self.reset()
-            for i in id_array:
-                addr = data_id[i][0]
-                addr_h = (addr >> 8) & 0xFF # separate upper 8-bits of addr
-                addr_l = addr & 0xFF # separate lower 8-bits of addr
-                length = data_id[i][1]
-                type = data_id[i][2]
-                label = data_id[i][3]
+            for r in self.read_id_iter(id_array, force_refresh):
+                i = r.id
+                addr, length, type, label = data_id[i]
 
-                response = self.cmd(addr_h, addr_l, length, (length + 5))
-                if response and len(response) >= 4 and response[0] == 0x81:
-                    # extract payload. message without header and cksum
-                    data = response[3:(3+length)]
-                                        
-                    # process data according to type
-                    # (uint, date, ascii, sn, adc_t, dec_t, cell_v)
+                array_value = value = r.value
+                if r.value is None:
+                    value = "------"
+                else:
+                    # format value according to type and output
                     match type:
-                        case "uint":
-                            array_value = value = int.from_bytes(data, 'big')
                         case "date":
-                            array_value = self.bytes2dt(data)
                             value = array_value.strftime('%Y-%m-%d %H:%M:%S')
-                        case "hhmmss":
-                            dur = int.from_bytes(data, 'big')
-                            mm, ss = divmod(dur, 60)
-                            hh, mm = divmod(mm, 60)
-                            array_value = value = f"{hh}:{mm:02d}:{ss:02d}"
-                        case "ascii":
-                            str = data.decode('utf-8')
-                            array_value = value = f'\"{str}\"'
                         case "sn":
-                            btype = int.from_bytes(data[0:2],'big')
-                            serial = int.from_bytes(data[2:5],'big')
-                            if( output == "label" or output == "array" ):
-                                array_value = value = f"Type: {btype:3d}, Serial: {serial:d}"
-                            else:
+                            if not ( output == "label" or output == "array" ):
+                                btype = int.from_bytes(r.raw[0:2],'big')
+                                serial = int.from_bytes(r.raw[2:5],'big')
                                 value = f"{btype}\n{serial}"
-                        case "adc_t":
-                            array_value = value = self.calculate_temperature(int.from_bytes(data, 'big'))
-                        case "dec_t":
-                            temp = data[0] + data[1]/256
-                            array_value = value = f"{temp:.2f}"
                         case "cell_v":
-                            array_value = cv = [int.from_bytes(data[i:i+2], 'big') for i in range(0, 10, 2)]
+                            cv = array_value
                             if( output == "label" ):
                                 value = f"1: {cv[0]:4d}, 2: {cv[1]:4d}, 3: {cv[2]:4d}, 4: {cv[3]:4d}, 5: {cv[4]:4d}"
                             else:
                                 value = f"{cv[0]:4d}\n{cv[1]:4d}\n{cv[2]:4d}\n{cv[3]:4d}\n{cv[4]:4d}"
-                   
-                else:
-                    array_value = None
-                    value = "------"
                 
                 if( output == "label" ):
                     # Print formatted data
@@ -715,8 +1757,6 @@ class M18:
                     
             if( (output == "array" or output == "form") and array ):        
                 return array
-                    
-            self.idle()
         except Exception as e:
             print(f"read_id: Failed with error: {e}")
 
@@ -763,130 +1803,110 @@ class M18:
             print(f"read_all_spreadsheet: Failed with error: {e}")
             
     
+    def read_image(self, id_array = [], force_refresh=True):
+        """
+        Read registers and return their raw payloads as {addr: bytes}.
+        Registers that did not give a valid response are left out.
+        # id_array - data_id indexes to read. Default is all
+        # force_refresh - force a read of all registers to ensure they're up to date
+        """
+        return {r.addr: r.raw for r in self.read_id_iter(id_array, force_refresh) if r.raw is not None}
+
+    def read_register(self, id):
+        """
+        Read one register by data_id index and return a Reading.
+        Does not reset() or refresh first.
+        """
+        reg = register_map[id]
+        response = self.cmd(reg.addr >> 8, reg.addr & 0xFF, reg.length, (reg.length + 5))
+        now = datetime.datetime.now()
+        if not self.verify_response(response, reg.length):
+            return Reading(reg.id, reg.addr, reg.type, None, None, now)
+        data = bytes(response[3:(3+reg.length)])
+        try:
+            value = decode_value(reg.type, data)
+        except Exception:
+            value = None
+        return Reading(reg.id, reg.addr, reg.type, value, data, now)
+
+    def triage(self, rules = None, order = None, alternatives = None):
+        """
+        Quickly decide whether a pack should be rejected.
+
+        Registers are read in 'order' (default triage_order) and each of
+        'rules' (default triage_rules) is checked as soon as its register
+        arrives. Reading stops at the first rule that rejects the pack.
+        Only the part of the 0x9000 data that is needed is refreshed, and
+        only once a 0x9000 register is reached.
+
+        A register that can't be read gives None in 'values'. If the battery
+        does not respond at all the verdict is "unknown".
+
+        Returns a TriageResult
+        """
+        rules = triage_rules if rules is None else rules
+        order = triage_order if order is None else order
+        alternatives = triage_alternatives if alternatives is None else alternatives
+        start = time.time()
+        values = {}
+        reasons = []
+        try:
+            if self.reset():
+                refreshed = False
+                for n, id in enumerate(order):
+                    try:
+                        if not refreshed and register_map.region(register_map[id].addr):
+                            # Refresh only the chunks holding the RAM registers still to read
+                            refreshed = True
+                            ram = [i for i in order[n:] if register_map.region(register_map[i].addr)]
+                            self.refresh([[addr >> 8, addr & 0xFF, length]
+                                          for addr, length in register_map.plan_for(ram)])
+                            self.reset()
+                        value = self.read_register(id).value
+                    except ValueError as e:
+                        print(f"triage: Failed with error: {e}")
+                        value = None
+                    values[id] = value
+                    if value is None:
+                        continue
+                    for reason, rule_id, test in rules:
+                        if rule_id == id and test(value):
+                            reasons.append(reason)
+                    if reasons:
+                        break
+        finally:
+            self.idle()
+
+        missing = {rule[1] for rule in rules if values.get(rule[1]) is None}
+        for group in alternatives:
+            if any(values.get(i) is not None for i in group):
+                missing -= set(group)
+        if reasons:
+            verdict = "reject"
+        elif missing:
+            verdict = "unknown"
+        else:
+            verdict = "pass"
+        return TriageResult(verdict, reasons, values, time.time() - start)
+
+    def read_health(self, force_refresh = True):
+        """
+        Read the registers used by health() and return a HealthRecord
+        """
+        return health_record(self.read_image(self.HEALTH_REGISTERS, force_refresh))
+
     def health(self, force_refresh = True):
         """
         Print labelled and formatted summary of key data.
         Some data is calculated, like 'imbalance' and 'total time on tool'
         Print simple histogram of discharge stats
         """
-        reg_list = [
-            4,  # 0.  Manufacture date
-            28, # 1.  Days since first charge
-            25, # 2.  Days since last tool use (corrected for current time)
-            26, # 3.  Days since last charge (corrected for current time)
-            12, # 4.  Voltages and imbalance
-            13, # 5.  temp (non-forge)
-            18, # 6.  temp (forge)
-            29, # 7.  Total discharge (Ah)
-            39, # 8.  Discharged to empty (count)
-            40, # 9.  Overheat events
-            41, # 10. Overcurrent events
-            42, # 11. Low-voltage events
-            43, # 12. Low-voltage bounce
-            33, 32, 31, # 13, 14, 15. Redlink, dumb, total charge count
-            35, # 16. Total charge time
-            36, # 17. Time idling on charger
-            38  # 18. Low-voltage charges (any cell <2.5V)
-        ] 
-        reg_list += range(44,64) # 19-38. discharge buckets (10-20A, 20-30A, ..., 200A+)
-        reg_list += [
-            8,  # 39. System date
-            2   # 40. type & serial
-        ] 
-        
-        
         # turn off debugging messages
         self.txrx_save_and_set(False)
         
         try:
             print("Reading battery. This will take 5-10sec\n")
-            array = self.read_id(reg_list, force_refresh, "array")
-            
-            sn = array[40][1]
-            numbers = re.findall(r'\d+\.?\d*', sn)
-            bat_type = numbers[0]
-            e_serial = numbers[1]
-            bat_lookup = {
-                "36": [1.5, "1.5Ah CP (5s1p 18650)"],
-                "37": [2, "2Ah CP (5s1p 18650)"],
-                "38": [3, "3Ah XC (5s2p 18650)"],
-                "39": [4, "4Ah XC (5s2p 18650)"],
-                "40": [5, "5Ah XC (5s2p 18650) (<= May 2019)"],
-                "165": [5, "5Ah XC (5s2p 18650) (Unknnown - Jan 2021)"],
-                "306": [5, "5Ah XC (5s2p 18650) (>= Feb 2021)"],                
-                "424": [5, "5Ah Resistant (5s2p 18650)"],
-                "46": [6, "6Ah XC (5s2p 18650)"],
-                "47": [9, "9Ah HD (5s3p 18650)"],                
-                "104": [3, "3Ah HO (5s1p 21700)"],
-                "106": [6, "6Ah HO (5s2p 21700)"],
-                "107": [8, "8Ah HO (5s2p 21700)"],
-                "108": [12, "12Ah HO (5s3p 21700)"],
-                "383": [8, "8Ah Forge (5s2p 21700 tabless)"],
-                "384": [12, "12Ah Forge (5s3p 21700 tabless)"]
-            }
-            bat_text = bat_lookup.get(bat_type, [0, "Unknown"])
-            print(f"Type: {bat_type} [{bat_text[1]}]")
-            print("E-serial:", e_serial, "(does NOT match case serial)")
-            
-            #now = datetime.datetime.now(datetime.timezone.utc)
-            bat_now = array[39][1]
-            
-            #print("Manufacture date: ", array[0].strftime('%Y-%m-%d %H:%M:%S') )
-            print("Manufacture date:", array[0][1].strftime('%Y-%m-%d') )
-            print("Days since 1st charge:", array[1][1])
-            print("Days since last tool use:", (bat_now - array[2][1]).days )
-            print("Days since last charge:", (bat_now - array[3][1]).days )
-            print("Pack voltage:", sum(array[4][1])/1000 )
-            print("Cell Voltages (mV):", array[4][1] )
-            print("Cell Imbalance (mV):", max(array[4][1]) - min(array[4][1]) )
-            if( array[5][1] ):
-                print("Temperature (deg C):", array[5][1])
-            if( array[6][1] ):
-                print("Temperature (deg C):", array[6][1])
-            
-            print("\nCHARGING STATS:")
-            print(f"Charge count [Redlink, dumb, (total)]: {(array[13][1])}, {(array[14][1])}, ({(array[15][1])})")
-            print("Total charge time:", array[16][1])
-            print("Time idling on charger:", array[17][1])
-            print("Low-voltage charges (any cell <2.5V):", array[18][1])
-            
-            print("\nTOOL USE STATS:")
-            print("Total discharge (Ah):", f"{array[7][1]/3600:.2f}")
-            if bat_text[0] != 0:
-                total_discharge_cycles = f"{array[7][1] / 3600 / bat_text[0]:.2f}"
-            else:
-                total_discharge_cycles = 'Unknown battery type, unable to calculate'
-            print("Total discharge cycles:", total_discharge_cycles)
-            print("Times discharged to empty:", array[8][1])
-            print("Times overheated:", array[9][1])
-            print("Overcurrent events:", array[10][1])
-            print("Low-voltage events:", array[11][1])
-            print("Low-voltage bounce/stutter:", array[12][1])
-            
-            tool_time = 0
-            for i in range(19,39):
-                tool_time += array[i][1]
-                
-            print("Total time on tool (>10A):", datetime.timedelta(seconds=tool_time))
-                
-            for i,j in enumerate(range(19,38)):
-                amp_range = f"{(i+1)*10}-{(i+2)*10}A"
-                label = f"Time @ {amp_range:>8}:"
-                t = array[j][1]
-                hhmmss = datetime.timedelta(seconds=t)
-                pct = round( (t/tool_time)*100 )
-                bar = "X" * round(pct)
-                print(label, hhmmss, f"{pct:2d}%", bar)
-            # Do last label different
-            j += 1
-            amp_range = f"> 200A"
-            label = f"Time @ {amp_range:>8}:"
-            t = array[j][1]
-            hhmmss = datetime.timedelta(seconds=t)
-            pct = round( (t/tool_time)*100 )
-            bar = "X" * round(pct)
-            print(label, hhmmss, f"{pct:2d}%", bar)
-                
+            print_health(self.read_health(force_refresh))
         except Exception as e:
             print(f"health: Failed with error: {e}")
             print("Check battery is connected and you have correct serial port")
@@ -942,7 +1962,8 @@ class M18:
             "entry.716337020": s_output
         }
 
-        # Submit the form
+        # Submit the form. requests is slow to import and only needed here
+        import requests
         response = requests.post(form_url, data=form_data)
 
         # Check response
@@ -959,6 +1980,7 @@ class M18:
             m.health() - print simple health report on battery \n \
             m.read_id() - print labelled and formatted diagnostics \n \
             m.read_id(output=\"raw\") - print in spreadsheet format \n \
+            m.triage() - quick reject/pass check, stops at the first reason to reject \n \
             m.submit_form() - prompts for manual inputs and submits battery diagnostics data \n \
             \n \
             m.help() - this message\n \
@@ -984,7 +2006,8 @@ class M18:
             m.txrx_print(bool) - set PRINT_TX & RX to bool \n \
             m.txrx_save_and_set(bool) - save PRINT_TX & RX state, then set both to bool \n \
             m.txrx_restore() - restore PRINT_TX & RX to saved values \n \
-            m.brute(addr_msb, addr_lsb) \n \
+            m.rx.errors - counts of stray/corrupt/short/stale frames received \n \
+            m.brute(addr_msb, addr_lsb) - try every length at [addr_msb addr_lsb], print valid responses and the known registers in them \n \
             m.full_brute(start, stop, len) - check registers from 'start' to 'stop'. look for 'len' bytes \n \
             m.debug(addr_msb, addr_lsb, len, rsp_len) - send reset() then cmd() to battery \n \
             m.try_cmd(cmd, addr_h, addr_l, len) - try 'cmd' at [addr_h addr_l] with 'len' bytes \n \
@@ -999,7 +2022,370 @@ class M18:
             m.keepalive() - send charge current request (0x62) \n") 
 
 
-if __name__ == '__main__':
+def json_value(value):
+    """
+    Convert a value from read_id(output="array") into something json can
+    serialise. Dates become ISO 8601 strings, time differences seconds,
+    everything else is unchanged.
+    """
+    if isinstance(value, datetime.datetime):
+        return value.isoformat()
+    if isinstance(value, datetime.timedelta):
+        return value.total_seconds()
+    return value
+
+
+def registers_json(array):
+    """
+    Convert the [id, value] pairs returned by read_id(output="array") into
+    a list of dicts labelled from data_id.
+    """
+    registers = []
+    for i, value in array:
+        addr, length, type, label = data_id[i]
+        registers.append({
+            "id": i,
+            "addr": f"0x{addr:04X}",
+            "len": length,
+            "type": type,
+            "label": label.strip(),
+            "value": json_value(value),
+        })
+    return registers
+
+
+def series_channels(ids):
+    """
+    Channel names and scales for recording data_id registers with
+    m18_series. Cell voltages are one channel per cell and temperatures
+    are stored in 1/100 C.
+    """
+    names, scales = [], []
+    for i in ids:
+        addr, length, type, label = data_id[i]
+        match type:
+            case "cell_v":
+                names += [f"cell{n}" for n in range(1, 6)]
+                scales += [1] * 5
+            case "adc_t" | "dec_t":
+                names.append(f"0x{addr:04X}")
+                scales.append(100)
+            case "uint":
+                names.append(f"0x{addr:04X}")
+                scales.append(1)
+            case _:
+                raise ValueError(f"Register {i} ({label.strip()}) is not numeric and can't be recorded")
+    return names, scales
+
+
+def series_values(array):
+    """
+    Flatten read_id(output="array") values in the order of series_channels().
+    Returns None if a register could not be read
+    """
+    values = []
+    for i, value in array:
+        if value is None:
+            return None
+        if isinstance(value, list):
+            values += value
+        else:
+            values.append(float(value))
+    return values
+
+
+def emit(obj, file=None):
+    """ Print obj as a single line of JSON and flush (for NDJSON consumers) """
+    file = file or sys.stdout
+    file.write(json.dumps(obj) + "\n")
+    file.flush()
+
+
+def cli_discover(args):
+    from serial.tools import list_ports
+    ports = [{"device": p.device, "manufacturer": p.manufacturer, "description": p.description,
+              "hwid": p.hwid} for p in list_ports.comports()]
+    emit(ports)
+    return 0
+
+
+def cli_idle(args):
+    m = M18(args.port)
+    m.idle()
+    emit({"port": args.port, "idle": True})
+    return 0
+
+
+def image_registers(image, id_array = []):
+    """
+    Decode a register image {addr: bytes} into the [id, value] pairs
+    read_id(output="array") would give. Missing registers are None.
+    """
+    if ( len(id_array) == 0 ):
+        id_array = range(0,len(data_id))
+    array = []
+    for i in id_array:
+        reg = register_map[i]
+        data = image.get(reg.addr)
+        array.append([i, decode_value(reg.type, data) if data is not None else None])
+    return array
+
+
+def cli_read(args, id_array):
+    """ Read a register image. Returns (time, image), or None after printing the error """
+    m = M18(args.port)
+    now = datetime.datetime.now()
+    try:
+        # read_image reports retries with print(). Keep stdout clean for JSON
+        with contextlib.redirect_stdout(sys.stderr):
+            image = m.read_image(id_array, not args.no_refresh)
+    except Exception as e:
+        m.idle()
+        emit({"port": args.port, "time": now.isoformat(), "error": str(e)})
+        return None
+    return now, image
+
+
+def cli_health(args):
+    if args.snapshots:
+        # Offline: calculate from saved snapshots, no battery needed
+        for snap in load_snapshots(args.snapshots):
+            record = health_record(snap["image"])
+            if args.text:
+                print(json_value(snap.get("time")))
+                try:
+                    print_health(record)
+                except Exception as e:
+                    print(f"health: Failed with error: {e}")
+                print()
+            else:
+                emit({"port": snap.get("port"), "time": json_value(snap.get("time")),
+                      "health": record_json(record)})
+        return 0
+    if args.port is None:
+        print("health requires --port or --snapshots", file=sys.stderr)
+        return 2
+    if args.text:
+        m = M18(args.port)
+        m.health(not args.no_refresh)
+        return 0
+    result = cli_read(args, M18.HEALTH_REGISTERS)
+    if result is None:
+        return 1
+    now, image = result
+    emit({"port": args.port, "time": now.isoformat(), "health": record_json(health_record(image)),
+          "image": image_to_json(image)})
+    return 0
+
+
+def reading_json(r):
+    """ Convert a Reading into a dict json can serialise, labelled from data_id """
+    return {
+        "id": r.id,
+        "addr": f"0x{r.addr:04X}",
+        "type": r.type,
+        "label": data_id[r.id][3].strip(),
+        "value": json_value(r.value),
+        "raw": r.raw.hex() if r.raw is not None else None,
+        "time": r.time.isoformat(),
+    }
+
+
+def cli_dump(args):
+    if args.stream:
+        m = M18(args.port)
+        try:
+            for r in m.read_id_iter([], not args.no_refresh):
+                emit(dict(port=args.port, **reading_json(r)))
+        except Exception as e:
+            emit({"port": args.port, "time": datetime.datetime.now().isoformat(), "error": str(e)})
+            return 1
+        return 0
+    result = cli_read(args, [])
+    if result is None:
+        return 1
+    now, image = result
+    emit({"port": args.port, "time": now.isoformat(), "registers": registers_json(image_registers(image)),
+          "image": image_to_json(image)})
+    return 0
+
+
+def change_json(c):
+    """ Convert a RegisterChange into a dict json can serialise """
+    return {
+        "id": c.id,
+        "addr": f"0x{c.addr:04X}",
+        "type": c.type,
+        "label": c.label,
+        "old": json_value(c.old),
+        "new": json_value(c.new),
+        "delta": json_value(c.delta),
+    }
+
+
+def image_serial(image):
+    """ Electronic serial number from an image, or None """
+    sn = image.get(register_map[2].addr)
+    return int.from_bytes(sn[2:5], 'big') if sn else None
+
+
+def cli_diff(args):
+    # Snapshots of each pack in file order
+    packs = {}
+    for snap in load_snapshots(args.snapshots):
+        packs.setdefault(image_serial(snap["image"]), []).append(snap)
+
+    if args.port is not None:
+        # Compare a fresh read with the pack's latest snapshot
+        result = cli_read(args, [])
+        if result is None:
+            return 1
+        now, image = result
+        serial = image_serial(image)
+        if serial not in packs:
+            emit({"port": args.port, "time": now.isoformat(), "error": f"No snapshot of pack {serial}"})
+            return 1
+        packs = {serial: [packs[serial][-1], {"time": now, "image": image}]}
+    elif args.first_last:
+        packs = {serial: [snaps[0], snaps[-1]] for serial, snaps in packs.items() if len(snaps) > 1}
+
+    for serial, snaps in packs.items():
+        history = diff_history([snap["image"] for snap in snaps])
+        for a, b, changes in zip(snaps, snaps[1:], history):
+            if changes:
+                emit({"serial": serial, "from": json_value(a.get("time")), "to": json_value(b.get("time")),
+                      "changes": [change_json(c) for c in changes]})
+    return 0
+
+
+def cli_monitor(args):
+    ids = args.ids
+    record = None
+    if args.record:
+        import m18_series
+        try:
+            series_channels(ids)
+        except ValueError as e:
+            print(f"monitor: {e}", file=sys.stderr)
+            return 1
+    m = M18(args.port)
+    n = 0
+    try:
+        while (args.count == 0) or (n < args.count):
+            now = datetime.datetime.now()
+            with contextlib.redirect_stdout(sys.stderr):
+                array = m.read_id(ids, False, "array")
+            if array is None:
+                emit({"port": args.port, "time": now.isoformat(), "error": "read failed"})
+            elif args.record:
+                if record is None and any(value is not None for i, value in array):
+                    # Record the registers this pack has; it only has one of
+                    # the two temperatures (non-Forge 0x4014, Forge 0x401F)
+                    array = [[i, value] for i, value in array if value is not None]
+                    ids = [i for i, value in array]
+                    try:
+                        record = m18_series.SeriesWriter(args.record, *series_channels(ids))
+                    except ValueError as e:
+                        print(f"monitor: {e}", file=sys.stderr)
+                        return 1
+                values = series_values(array)
+                if values is None:
+                    missing = [f"0x{data_id[i][0]:04X}" for i, value in array if value is None]
+                    emit({"port": args.port, "time": now.isoformat(),
+                          "error": f"not recorded, can't read {', '.join(missing)}"})
+                else:
+                    record.append(now, values)
+            else:
+                emit({"port": args.port, "time": now.isoformat(), "registers": registers_json(array)})
+            n += 1
+            time.sleep(args.interval)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        m.idle()
+        if record is not None:
+            record.close()
+    return 0
+
+
+def cli_triage(args):
+    m = M18(args.port)
+    now = datetime.datetime.now()
+    try:
+        # triage reports read errors with print(). Keep stdout clean for JSON
+        with contextlib.redirect_stdout(sys.stderr):
+            result = m.triage()
+    except Exception as e:
+        emit({"port": args.port, "time": now.isoformat(), "error": str(e)})
+        return 1
+    emit({"port": args.port, "time": now.isoformat(), "triage": record_json(result)})
+    return 0
+
+
+def load_grader(path):
+    """ Compile a grading rules file (None = default rules). Returns None after printing the error """
+    import m18_grade
+    try:
+        return m18_grade.Grader.load(path)
+    except (OSError, ValueError) as e:
+        print(f"{path}: {e}", file=sys.stderr)
+        return None
+
+
+def cli_grade(args):
+    grader = load_grader(args.rules)
+    if grader is None:
+        return 2
+    result = cli_read(args, M18.HEALTH_REGISTERS)
+    if result is None:
+        return 1
+    now, image = result
+    emit({"port": args.port, "time": now.isoformat(), "grade": record_json(grader.grade(health_record(image))),
+          "image": image_to_json(image)})
+    return 0
+
+
+def cli_station(args):
+    m = M18(args.port)
+    steps = {
+        "dump": lambda m: image_to_json(m.read_image()),
+        "health": lambda m: record_json(m.read_health()),
+        "triage": lambda m: record_json(m.triage()),
+    }
+    if "grade" in args.pipeline:
+        grader = load_grader(args.rules)
+        if grader is None:
+            return 2
+        steps["grade"] = lambda m: record_json(grader.grade(m.read_health()))
+    pipeline = [(name, steps[name]) for name in args.pipeline]
+    out = sys.stdout
+
+    def on_pack(p):
+        p["port"] = args.port
+        p["time"] = p["time"].isoformat()
+        emit(p, out)
+
+    metrics = None
+    stop_dump = None
+    if args.metrics_port or args.metrics_file:
+        import m18_metrics
+        metrics = m18_metrics.Metrics(threshold=args.quarantine)
+        metrics.attach(m)
+        if args.metrics_port:
+            metrics.serve(args.metrics_port)
+        if args.metrics_file:
+            stop_dump = metrics.dump_every(args.metrics_file, args.metrics_interval)
+
+    with contextlib.redirect_stdout(sys.stderr):
+        m.station(pipeline, args.interval, args.misses, args.packs, on_pack)
+    if stop_dump is not None:
+        stop_dump()
+    if metrics is not None and metrics.quarantined(m.name):
+        return 1
+    return 0
+
+
+def main(argv=None):
     parser = argparse.ArgumentParser(
         description="M18 Protocol Interface",
         epilog="Connect UART-TX to M18-J2 and UART-RX to M18-J1 to fake the charger and UART-GND to M18-GND")
@@ -1007,7 +2393,69 @@ if __name__ == '__main__':
     parser.add_argument('--health', action='store_true', help='Print health report and exit')
     parser.add_argument('--ss', action='store_true', help='Spreadsheet output: Print all register values and exit')
     parser.add_argument('--idle', action='store_true', help='Set TX=Low and exit. Prevents unwanted charge increments')
-    args = parser.parse_args()
+
+    # Subcommands are non-interactive: they never show the port menu and
+    # print JSON (or NDJSON for streams) to stdout
+    port_parser = argparse.ArgumentParser(add_help=False)
+    port_parser.add_argument('--port', type=str, default=argparse.SUPPRESS,
+                             help="Serial port to connect to (e.g., COM5)")
+    read_parser = argparse.ArgumentParser(add_help=False, parents=[port_parser])
+    read_parser.add_argument('--no-refresh', action='store_true', help="Skip the dummy read of all registers")
+
+    commands = parser.add_subparsers(dest='command', metavar='COMMAND')
+    cmd = commands.add_parser('discover', help="List serial ports as JSON")
+    cmd.set_defaults(func=cli_discover)
+    cmd = commands.add_parser('idle', parents=[port_parser], help="Set TX=Low and exit")
+    cmd.set_defaults(func=cli_idle)
+    cmd = commands.add_parser('health', parents=[read_parser], help="Read health registers as JSON")
+    cmd.add_argument('--text', action='store_true', help="Print the human readable report instead")
+    cmd.add_argument('--snapshots', type=str,
+                     help="Calculate from a file of saved 'dump' output instead of reading a battery")
+    cmd.set_defaults(func=cli_health)
+    cmd = commands.add_parser('dump', parents=[read_parser], help="Read all registers as JSON")
+    cmd.add_argument('--stream', action='store_true',
+                     help="Print each register as one JSON line as soon as it is read")
+    cmd.set_defaults(func=cli_dump)
+    cmd = commands.add_parser('triage', parents=[port_parser], help="Quick reject/pass check as JSON")
+    cmd.set_defaults(func=cli_triage)
+    cmd = commands.add_parser('diff', parents=[read_parser],
+                              help="Changed registers between snapshots of each pack as NDJSON")
+    cmd.add_argument('--snapshots', type=str, required=True, help="File of saved 'dump' output")
+    cmd.add_argument('--first-last', action='store_true',
+                     help="Only compare each pack's first and last snapshot")
+    cmd.set_defaults(func=cli_diff)
+    cmd = commands.add_parser('monitor', parents=[port_parser], help="Read registers repeatedly as NDJSON")
+    cmd.add_argument('--ids', type=int, nargs='+', default=[12, 13, 18],
+                     help="data_id indexes to read (default: cell voltages and temperatures)")
+    cmd.add_argument('--interval', type=float, default=1.0, help="Seconds between reads")
+    cmd.add_argument('--count', type=int, default=0, help="Number of reads (0 = until interrupted)")
+    cmd.add_argument('--record', type=str, metavar='FILE',
+                     help="Append samples to a compressed series file (m18_series) instead of printing them")
+    cmd.set_defaults(func=cli_monitor)
+    cmd = commands.add_parser('grade', parents=[read_parser], help="Grade a pack with a rules file as JSON")
+    cmd.add_argument('--rules', type=str, help="Rules file (TOML, see m18_grade.py). Default: built-in rules")
+    cmd.set_defaults(func=cli_grade)
+    cmd = commands.add_parser('station', parents=[port_parser],
+                              help="Wait for batteries and read each one as NDJSON")
+    cmd.add_argument('--pipeline', nargs='+', choices=['dump', 'health', 'triage', 'grade'], default=['dump'],
+                     help="What to read from each pack")
+    cmd.add_argument('--rules', type=str, help="Rules file for the grade step (default: built-in rules)")
+    cmd.add_argument('--interval', type=float, default=1.0, help="Seconds between probes")
+    cmd.add_argument('--misses', type=int, default=2, help="Failed probes before a pack counts as removed")
+    cmd.add_argument('--packs', type=int, default=0, help="Stop after this many packs (0 = until interrupted)")
+    cmd.add_argument('--metrics-port', type=int, help="Serve Prometheus metrics on this local port")
+    cmd.add_argument('--metrics-file', type=str, help="Append metrics as JSON lines to this file")
+    cmd.add_argument('--metrics-interval', type=float, default=60.0, help="Seconds between --metrics-file lines")
+    cmd.add_argument('--quarantine', type=float, default=0.5,
+                     help="Stop when more than this fraction of recent syncs fail (needs --metrics-*)")
+    cmd.set_defaults(func=cli_station)
+
+    args = parser.parse_args(argv)
+
+    if args.command is not None:
+        if (args.port is None) and (args.command not in ('discover', 'health', 'diff')):
+            parser.error(f"{args.command} requires --port")
+        return args.func(args)
 
     # --ss flag must also have --port set.
     # This prevents 'm18.py --ss | clip.exe' getting stuck in menu they can't see
@@ -1023,6 +2471,11 @@ if __name__ == '__main__':
         elif args.ss:
             m.read_id(output="raw")
         else:
+            import code
             m.help()
-            code.InteractiveConsole(locals = locals()).interact('Entering shell...')    
-    
+            code.InteractiveConsole(locals = {**globals(), **locals()}).interact('Entering shell...')
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
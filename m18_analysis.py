@@ -0,0 +1,231 @@
+"""
+Statistics to help identify the "Unknown" registers in data_id.
+
+Loads the unknown registers and the known counters from snapshot files
+(the output of 'm18.py dump') into one column per register and, for every
+unknown register, ranks the known counters it moves with:
+
+  r        correlation of the values across all snapshots (the whole fleet)
+  r delta  correlation of the changes between consecutive snapshots of the
+           same pack. A counter that counts the same events as a known one
+           has r delta close to 1 even if it started from a different value
+  up       fraction of changes of the register that are increases
+           (1.00 for a counter)
+  per day  average change per day, using 'Days since first charge'
+
+Usage:
+    python m18_analysis.py snapshots.ndjson [more.ndjson ...]
+    python m18_analysis.py snapshots.ndjson --ids 179 --top 5
+    python m18_analysis.py snapshots.ndjson --json > ranking.ndjson
+
+All registers involved are read as big-endian integers (dates as seconds
+since the epoch). A register missing from a snapshot (e.g. a Forge-only
+register of a non-Forge pack) is missing from its column only, and each
+correlation uses the snapshots that have both registers. Snapshots with
+none of the selected registers are skipped.
+"""
+import argparse
+import itertools
+import json
+import math
+import operator
+import sys
+
+import m18
+
+# Known registers to compare against: days since first charge, discharge,
+# charge counts and times, and the event counters
+KNOWN_IDS = [28, 29, 30, 31, 32, 33, 34, 35, 36, 38, 39, 40, 41, 42, 43]
+DAYS_ID = 28
+
+
+def unknown_ids():
+    """ ids of the data_id registers labelled as unknown """
+    return [reg.id for reg in m18.register_map.registers if reg.label.startswith("Unknown")]
+
+
+def decode(value):
+    """ Hex string from a snapshot image -> integer, or None if missing or invalid """
+    try:
+        return int(value, 16)
+    except (TypeError, ValueError):
+        return None
+
+
+def delta(b, a):
+    return None if a is None or b is None else b - a
+
+
+def present(values):
+    return [v for v in values if v is not None]
+
+
+class Fleet:
+    """
+    Columns of register values from many snapshots, sorted by pack (serial)
+    and time. 'columns[id]' is a list with one integer per snapshot and
+    'deltas[id]' the changes between consecutive snapshots of the same pack.
+    Values (and deltas with either end) missing from a snapshot are None.
+    """
+    def __init__(self, ids):
+        self.ids = list(ids)
+        self.keys = [f"0x{m18.register_map[i].addr:04X}" for i in self.ids]
+        self.rows = []     # (serial, time, [values])
+        self.skipped = 0
+
+    def load(self, path):
+        """ Add the snapshots from a file. Only the selected registers are decoded """
+        sn_key = f"0x{m18.register_map[2].addr:04X}"
+        with open(path) as f:
+            for line in f:
+                if '"image"' not in line:
+                    continue
+                snap = json.loads(line)
+                image = snap["image"]
+                values = [decode(image.get(key)) for key in self.keys]
+                if values.count(None) == len(values):
+                    self.skipped += 1
+                    continue
+                sn = image.get(sn_key)
+                serial = int(sn[4:10], 16) if sn else None
+                self.rows.append((serial, snap.get("time") or "", values))
+
+    def build(self):
+        """ Sort the rows and build the columns. Call after load() """
+        self.rows.sort(key=lambda row: (row[0] is None, row[0] or 0, row[1]))
+        serials = [row[0] for row in self.rows]
+        # Row n and n + 1 are consecutive snapshots of the same pack
+        same = [a is not None and a == b for a, b in zip(serials, serials[1:])]
+        columns = list(zip(*(row[2] for row in self.rows))) or [()] * len(self.ids)
+        self.columns = {i: list(col) for i, col in zip(self.ids, columns)}
+        self.deltas = {i: list(itertools.compress(map(delta, col[1:], col), same))
+                       for i, col in self.columns.items()}
+
+    def __len__(self):
+        return len(self.rows)
+
+
+class Column:
+    """
+    A column with the sums needed for correlations, computed once. The sums
+    are only used between two columns with no missing values; otherwise
+    they are recomputed over the rows both have
+    """
+    def __init__(self, values):
+        self.values = values
+        self.mask = [v is not None for v in values]
+        self.complete = all(self.mask)
+        known = values if self.complete else present(values)
+        self.n = len(known)
+        self.sum = sum(known)
+        self.var = self.n * sum(map(operator.mul, known, known)) - self.sum * self.sum
+
+    def correlation(self, other):
+        """ Pearson correlation over the rows both have a value in, or None if either is constant """
+        if not (self.complete and other.complete):
+            both = list(map(operator.and_, self.mask, other.mask))
+            return Column(list(itertools.compress(self.values, both))).correlation(
+                Column(list(itertools.compress(other.values, both))))
+        if self.n < 2 or not self.var or not other.var:
+            return None
+        cov = self.n * sum(map(operator.mul, self.values, other.values)) - self.sum * other.sum
+        return cov / math.sqrt(self.var * other.var)
+
+
+def analyse(fleet, unknown, known, top=3):
+    """
+    Rank the known registers for each unknown register. Returns a list of
+    dicts, one per unknown register, in the order of 'unknown'.
+    """
+    levels = {i: Column(fleet.columns[i]) for i in set(unknown) | set(known)}
+    deltas = {i: Column(fleet.deltas[i]) for i in set(unknown) | set(known)}
+    # Steps in which 'Days since first charge' went up
+    days = fleet.deltas.get(DAYS_ID, [])
+    day_steps = [d is not None and d > 0 for d in days]
+
+    results = []
+    for u in unknown:
+        reg = m18.register_map[u]
+        column = present(fleet.columns[u])
+        delta = fleet.deltas[u]
+        steps = [d is not None and day for d, day in zip(delta, day_steps)]
+        total_days = sum(itertools.compress(days, steps))
+        delta = present(delta)
+        changes = len(delta) - delta.count(0)
+        ups = sum(map((0).__lt__, delta))
+        rate = sum(itertools.compress(fleet.deltas[u], steps)) / total_days if total_days else None
+
+        matches = []
+        for k in known:
+            if k == u:
+                continue
+            r = levels[u].correlation(levels[k])
+            rd = deltas[u].correlation(deltas[k])
+            if r is None and rd is None:
+                continue
+            score = abs(rd) if rd is not None else abs(r)
+            matches.append({"id": k, "label": m18.register_map[k].label.strip(),
+                            "r": r, "r_delta": rd, "score": score})
+        matches.sort(key=lambda m: m["score"], reverse=True)
+
+        results.append({
+            "id": u,
+            "addr": f"0x{reg.addr:04X}",
+            "label": reg.label.strip(),
+            "min": min(column) if column else None,
+            "max": max(column) if column else None,
+            "changes": changes,
+            "up": ups / changes if changes else None,
+            "per_day": rate,
+            "matches": matches[:top],
+        })
+    return results
+
+
+def print_results(results, count):
+    def num(v, fmt):
+        return "-" if v is None else format(v, fmt)
+
+    print(f"{count} snapshots")
+    for res in results:
+        print()
+        print(f"{res['addr']} {res['label']}")
+        if res["min"] == res["max"]:
+            print(f"    constant {res['min']}")
+            continue
+        print(f"    range {res['min']}..{res['max']}, {res['changes']} changes, "
+              f"up {num(res['up'], '.2f')}, per day {num(res['per_day'], '.3g')}")
+        for m in res["matches"]:
+            print(f"    r {num(m['r'], '+.2f')}  r delta {num(m['r_delta'], '+.2f')}  {m['label']}")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Rank likely meanings of unknown M18 registers")
+    parser.add_argument('snapshots', nargs='+', help="Snapshot files ('m18.py dump' output)")
+    parser.add_argument('--ids', type=int, nargs='+', help="data_id indexes to analyse (default: all unknown)")
+    parser.add_argument('--known', type=int, nargs='+', default=KNOWN_IDS,
+                        help="data_id indexes to compare with (default: counters)")
+    parser.add_argument('--top', type=int, default=3, help="Matches to show per register")
+    parser.add_argument('--json', action='store_true', help="Print one JSON object per register")
+    args = parser.parse_args(argv)
+
+    unknown = args.ids or unknown_ids()
+    ids = list(dict.fromkeys(unknown + args.known + [DAYS_ID]))
+    fleet = Fleet(ids)
+    for path in args.snapshots:
+        fleet.load(path)
+    fleet.build()
+    if fleet.skipped:
+        print(f"Skipped {fleet.skipped} snapshots without any of the registers", file=sys.stderr)
+
+    results = analyse(fleet, unknown, args.known, args.top)
+    if args.json:
+        for res in results:
+            print(json.dumps(res))
+    else:
+        print_results(results, len(fleet))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
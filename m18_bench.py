@@ -0,0 +1,214 @@
+"""
+Benchmarks for m18.py
+
+Measures:
+  codec    - reverse_bits, checksum and command framing throughput
+  decode   - decode_value() over a full data_id register image
+  session  - read_id, health, read_all and brute against a simulated
+             battery (m18_sim) with 4800 baud wire timing
+
+Usage:
+    python m18_bench.py                       # run everything, print results
+    python m18_bench.py --save base.json      # save results as a baseline
+    python m18_bench.py --compare base.json   # compare with a saved baseline
+    python m18_bench.py --fast                # virtual clock, no wire sleeps
+
+With --fast the simulated battery does not sleep. Session times are then
+the real time spent in m18.py (including its own time.sleep calls) plus the
+modelled time spent waiting for the wire, which is close to the real-time
+result but much quicker to measure.
+"""
+import argparse
+import contextlib
+import datetime
+import io
+import json
+import platform
+import sys
+import time
+
+import m18
+import m18_sim
+
+# Number of register addresses full_brute() walks by default
+FULL_BRUTE_ADDRS = 0x10000
+
+
+def per_second(fn, count, min_time=0.5):
+    """
+    Call fn() (which does 'count' operations) until min_time has passed.
+    Returns operations per second of the fastest call.
+    """
+    best = None
+    total = 0.0
+    while total < min_time:
+        start = time.perf_counter()
+        fn()
+        elapsed = time.perf_counter() - start
+        total += elapsed
+        best = elapsed if best is None else min(best, elapsed)
+    return count / best
+
+
+def result(value, unit, higher_is_better=True):
+    return {"value": value, "unit": unit, "higher_is_better": higher_is_better}
+
+
+def bench_codec(m):
+    results = {}
+    data = bytes(range(256)) * 16
+    results["codec.reverse_bits"] = result(
+        per_second(lambda: [m.reverse_bits(b) for b in data], len(data)), "bytes/s")
+
+    command = bytes([0x01, 0x04, 0x03, 0x90, 0x00, 0x3A])
+    results["codec.checksum"] = result(
+        per_second(lambda: [m.checksum(command) for _ in range(1000)], 1000), "frames/s")
+
+    # What send_command() does before writing to the port
+    def frame():
+        for _ in range(1000):
+            bytearray(m.reverse_bits(b) for b in m.add_checksum(command))
+    results["codec.frame"] = result(per_second(frame, 1000), "frames/s")
+
+    # What read_response() does with a full 0x3A byte chunk
+    response = bytes(m_sim_frame(0x3A))
+    def unframe():
+        for _ in range(100):
+            bytearray(m.reverse_bits(b) for b in response)
+    results["codec.unframe"] = result(per_second(unframe, 100), "frames/s")
+    return results
+
+
+def m_sim_frame(length):
+    lsb = m18_sim.frame(0x81, 0x04, bytes(length))
+    return bytes(m18_sim.reverse_bits(b) for b in lsb)
+
+
+def bench_decode():
+    image = m18_sim.default_image()
+    regs = m18.register_map.registers
+
+    def decode():
+        for reg in regs:
+            m18.decode_value(reg.type, image[reg.addr])
+    rate = per_second(decode, 1)
+    return {
+        "decode.registers": result(rate * len(regs), "registers/s"),
+        "decode.images": result(rate, "images/s"),
+    }
+
+
+def run_session(fn, realtime, window=1):
+    """
+    Run fn(m) against a fresh simulated battery, discarding its output.
+    Returns (seconds, simulated battery)
+    """
+    sim = m18_sim.SimulatedBattery(realtime=realtime)
+    m = m18.M18(sim)
+    m.PIPELINE_WINDOW = window
+    with contextlib.redirect_stdout(io.StringIO()):
+        start = time.perf_counter()
+        fn(m)
+        elapsed = time.perf_counter() - start
+    if not realtime:
+        elapsed += sim.waited
+    return elapsed, sim
+
+
+def bench_session(runs, realtime, window=1):
+    results = {}
+    sessions = {
+        "read_id": lambda m: m.read_id(output="array"),
+        "health": lambda m: m.health(),
+        "read_all": lambda m: m.read_all(),
+    }
+    for name, fn in sessions.items():
+        best = None
+        for _ in range(runs):
+            elapsed, sim = run_session(fn, realtime, window)
+            if best is None or elapsed < best[0]:
+                best = (elapsed, sim)
+        elapsed, sim = best
+        frames = sum(sim.commands.values())
+        results[f"session.{name}.time"] = result(elapsed, "s", False)
+        results[f"session.{name}.frames"] = result(frames / elapsed, "frames/s")
+        results[f"session.{name}.bytes"] = result((sim.bytes_tx + sim.bytes_rx) / elapsed, "bytes/s")
+        if name == "health":
+            results["session.health.packs"] = result(3600 / elapsed, "packs/hour")
+
+    # full_brute() calls brute() for every address. Time brute() at two
+    # lengths and extrapolate to the default 0xFF lengths and all addresses
+    short, _ = run_session(lambda m: m.brute(0x90, 0x00, 8), realtime, window)
+    long, _ = run_session(lambda m: m.brute(0x90, 0x00, 24), realtime, window)
+    per_len = (long - short) / 16
+    per_addr = short - 8 * per_len + 0xFF * per_len
+    results["session.full_brute.time"] = result(per_addr * FULL_BRUTE_ADDRS / 3600, "hours", False)
+    return results
+
+
+def compare(results, baseline, threshold):
+    """ Print results next to the baseline. Returns number of regressions """
+    regressions = 0
+    print(f"{'BENCHMARK':<28} {'BASELINE':>14} {'CURRENT':>14} {'CHANGE':>8}")
+    for name, r in results.items():
+        base = baseline.get(name)
+        if base is None:
+            print(f"{name:<28} {'-':>14} {r['value']:>14.4g} {'new':>8}  {r['unit']}")
+            continue
+        change = (r["value"] - base["value"]) / base["value"] if base["value"] else 0.0
+        worse = -change if r["higher_is_better"] else change
+        flag = ""
+        if worse > threshold:
+            flag = "  REGRESSION"
+            regressions += 1
+        print(f"{name:<28} {base['value']:>14.4g} {r['value']:>14.4g} {change:>+8.1%}  {r['unit']}{flag}")
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark m18.py against a simulated battery")
+    parser.add_argument('--only', choices=["codec", "decode", "session"], action='append',
+                        help="Run only these groups (may be repeated)")
+    parser.add_argument('--runs', type=int, default=1, help="Runs per session benchmark (best is kept)")
+    parser.add_argument('--fast', action='store_true', help="Use a virtual clock for the wire")
+    parser.add_argument('--window', type=int, default=1, help="M18.PIPELINE_WINDOW for session benchmarks")
+    parser.add_argument('--save', type=str, help="Save results as a baseline JSON file")
+    parser.add_argument('--compare', type=str, help="Compare with a baseline JSON file")
+    parser.add_argument('--threshold', type=float, default=0.10,
+                        help="Relative change counted as a regression (default 0.10)")
+    args = parser.parse_args(argv)
+
+    groups = args.only or ["codec", "decode", "session"]
+    results = {}
+    m = m18.M18(m18_sim.SimulatedBattery(realtime=False))
+    if "codec" in groups:
+        results.update(bench_codec(m))
+    if "decode" in groups:
+        results.update(bench_decode())
+    if "session" in groups:
+        results.update(bench_session(args.runs, not args.fast, args.window))
+
+    status = 0
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)["results"]
+        if compare(results, baseline, args.threshold):
+            status = 1
+    else:
+        for name, r in results.items():
+            print(f"{name:<28} {r['value']:>14.4g}  {r['unit']}")
+
+    if args.save:
+        with open(args.save, "w") as f:
+            json.dump({
+                "time": datetime.datetime.now().isoformat(),
+                "python": platform.python_version(),
+                "fast": args.fast,
+                "window": args.window,
+                "results": results,
+            }, f, indent=2)
+    return status
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,236 @@
+"""
+Grade packs (keep, rebalance, scrap, ...) with rules from a TOML file.
+
+A rules file lists the grades from best to worst and the rules that move a
+pack to a worse grade. A pack gets the worst grade of the rules it
+triggers, or the first grade if it triggers none:
+
+    grades = ["keep", "rebalance", "scrap"]
+
+    [[rule]]
+    name = "Cell below 2.5V"
+    when = "min_cell < 2500"
+    grade = "scrap"
+
+'when' is '<metric> <op> <number>' with op one of < <= > >= == !=.
+Metrics are the numeric fields of m18.HealthRecord (imbalance,
+temperature, overheat_events, days_since_charge, ...) and:
+
+    min_cell, max_cell  lowest and highest cell voltage (mV)
+    max_temperature     the higher of temperature and temperature_forge, so
+                        one rule covers Forge and non-Forge packs
+    cycles              total discharge (0x9012) / capacity from bat_lookup
+
+A rule whose metric is unknown for a pack (register not read, unknown
+battery type) does not trigger. Without a rules file DEFAULT_RULES is used.
+
+The rules are compiled once into a Grader, which grades one HealthRecord
+(grade()) or a whole list of them at once, rule by rule (grade_all()).
+
+    python m18_grade.py --rules rules.toml snapshots.ndjson
+    python m18.py grade --port COM5 --rules rules.toml
+"""
+import argparse
+import collections
+import itertools
+import operator
+import re
+import sys
+import tomllib
+from typing import NamedTuple
+
+import m18
+
+DEFAULT_RULES = """
+grades = ["keep", "rebalance", "scrap"]
+
+[[rule]]
+name = "Cell below 2.5V"
+when = "min_cell < 2500"
+grade = "scrap"
+
+[[rule]]
+name = "Cell imbalance over 200mV"
+when = "imbalance > 200"
+grade = "scrap"
+
+[[rule]]
+name = "Cell imbalance over 50mV"
+when = "imbalance > 50"
+grade = "rebalance"
+
+[[rule]]
+name = "Temperature over 60C"
+when = "max_temperature > 60"
+grade = "scrap"
+
+[[rule]]
+name = "Overheated more than 10 times"
+when = "overheat_events > 10"
+grade = "scrap"
+
+[[rule]]
+name = "More than 20 overcurrent events"
+when = "overcurrent_events > 20"
+grade = "scrap"
+
+[[rule]]
+name = "Charged with a cell below 2.5V more than 3 times"
+when = "low_voltage_charges > 3"
+grade = "scrap"
+
+[[rule]]
+name = "Not charged for over 180 days"
+when = "days_since_charge > 180"
+grade = "rebalance"
+"""
+
+# Metrics that are not HealthRecord fields
+DERIVED = {
+    "min_cell": lambda r: min(r.cell_voltages) if r.cell_voltages else None,
+    "max_cell": lambda r: max(r.cell_voltages) if r.cell_voltages else None,
+    "max_temperature": lambda r: max((t for t in (r.temperature, r.temperature_forge) if t is not None),
+                                     default=None),
+    "cycles": lambda r: r.discharge_cycles,
+}
+
+OPS = {
+    "<": operator.lt,
+    "<=": operator.le,
+    ">": operator.gt,
+    ">=": operator.ge,
+    "==": operator.eq,
+    "!=": operator.ne,
+}
+
+WHEN = re.compile(r"^\s*(\w+)\s*(<=|>=|==|!=|<|>)\s*(-?[0-9.]+)\s*$")
+
+
+class Rule(NamedTuple):
+    name: str
+    metric: str
+    op: str
+    value: float
+    grade: str
+
+
+class Grade(NamedTuple):
+    grade: str
+    reasons: list   # names of the rules that triggered
+    values: dict    # metric -> value, for every metric the rules use
+
+
+def metric_getter(metric):
+    if metric in DERIVED:
+        return DERIVED[metric]
+    if metric in m18.HealthRecord._fields:
+        if m18.HealthRecord.__annotations__[metric] not in (int, float):
+            raise ValueError(f"Metric '{metric}' is not numeric")
+        return operator.attrgetter(metric)
+    raise ValueError(f"Unknown metric '{metric}'")
+
+
+class Grader:
+    """ Rules compiled for grading. See the module docstring """
+    def __init__(self, grades, rules):
+        self.grades = list(grades)
+        if not self.grades:
+            raise ValueError("No grades")
+        self.rules = []
+        for rule in rules:
+            name = rule.get("name") or rule.get("when")
+            match = WHEN.match(rule.get("when", ""))
+            if not match:
+                raise ValueError(f"Rule '{name}': can't parse when = '{rule.get('when')}'")
+            metric, op, value = match.groups()
+            metric_getter(metric)
+            if rule.get("grade") not in self.grades:
+                raise ValueError(f"Rule '{name}': grade '{rule.get('grade')}' is not one of {self.grades}")
+            self.rules.append(Rule(name, metric, op, float(value), rule["grade"]))
+
+        self.metrics = list(dict.fromkeys(r.metric for r in self.rules))
+        self.getters = [metric_getter(metric) for metric in self.metrics]
+        # Worst grades first, so the first rule that triggers decides the grade
+        self.rules.sort(key=lambda r: self.grades.index(r.grade), reverse=True)
+
+    @classmethod
+    def from_toml(cls, text):
+        rules = tomllib.loads(text)
+        return cls(rules.get("grades", []), rules.get("rule", []))
+
+    @classmethod
+    def load(cls, path=None):
+        """ Compile the rules in TOML file 'path', or DEFAULT_RULES """
+        if path is None:
+            return cls.from_toml(DEFAULT_RULES)
+        with open(path, "rb") as f:
+            rules = tomllib.load(f)
+        return cls(rules.get("grades", []), rules.get("rule", []))
+
+    def grade(self, record):
+        """ Grade one HealthRecord """
+        values = {metric: get(record) for metric, get in zip(self.metrics, self.getters)}
+        grade = self.grades[0]
+        reasons = []
+        for rule in self.rules:
+            v = values[rule.metric]
+            if v is not None and OPS[rule.op](v, rule.value):
+                if not reasons:
+                    grade = rule.grade
+                reasons.append(rule.name)
+        return Grade(grade, reasons, values)
+
+    def grade_all(self, records):
+        """
+        Grade a list of HealthRecords. Same result as grade() for each, but
+        each metric is extracted once into a column and each rule is applied
+        to a whole column
+        """
+        n = len(records)
+        columns = {metric: list(map(get, records)) for metric, get in zip(self.metrics, self.getters)}
+        severity = [0] * n
+        reasons = [[] for _ in range(n)]
+        for rule in self.rules:
+            test = OPS[rule.op]
+            value = rule.value
+            level = self.grades.index(rule.grade)
+            hits = [v is not None and test(v, value) for v in columns[rule.metric]]
+            for i in itertools.compress(range(n), hits):
+                reasons[i].append(rule.name)
+                if level > severity[i]:
+                    severity[i] = level
+        return [Grade(self.grades[severity[i]], reasons[i],
+                      {metric: columns[metric][i] for metric in self.metrics})
+                for i in range(n)]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Grade M18 packs from snapshot files")
+    parser.add_argument('snapshots', nargs='+', help="Snapshot files ('m18.py dump' or 'health' output)")
+    parser.add_argument('--rules', type=str, help="Rules file (TOML). Default: DEFAULT_RULES")
+    parser.add_argument('--latest', action='store_true', help="Only grade the last snapshot of each pack")
+    args = parser.parse_args(argv)
+
+    try:
+        grader = Grader.load(args.rules)
+    except (OSError, ValueError, tomllib.TOMLDecodeError) as e:
+        print(f"{args.rules}: {e}", file=sys.stderr)
+        return 2
+
+    snaps = [snap for path in args.snapshots for snap in m18.load_snapshots(path)]
+    if args.latest:
+        snaps = list({m18.image_serial(snap["image"]): snap for snap in snaps}.values())
+    records = [m18.health_record(snap["image"]) for snap in snaps]
+    grades = grader.grade_all(records)
+
+    for snap, record, g in zip(snaps, records, grades):
+        m18.emit({"serial": record.e_serial, "time": m18.json_value(snap.get("time")),
+                  "grade": g.grade, "reasons": g.reasons,
+                  "values": {k: m18.json_value(v) for k, v in g.values.items()}})
+    counts = collections.Counter(g.grade for g in grades)
+    print(", ".join(f"{grade}: {counts[grade]}" for grade in grader.grades), file=sys.stderr)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
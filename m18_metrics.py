@@ -0,0 +1,205 @@
+"""
+Metrics for M18 sessions and test stations.
+
+A Metrics object counts operations (syncs, register reads, station steps
+and packs) per port and operation, with latency histograms, and tracks
+the frame errors of the attached sessions. It can be read as
+
+  - Prometheus text format from a local HTTP port (serve()), and
+  - a line of JSON appended to a file every few seconds (dump_every()).
+
+It also quarantines an adapter whose recent sync failure rate is above
+'threshold'. Syncs are reset() calls and probes that got a reply (see
+M18.probe()). M18.station() stops when its adapter is quarantined.
+
+    metrics = m18_metrics.Metrics()
+    m = m18.M18("COM5")
+    metrics.attach(m)
+    metrics.serve(9118)
+    m.station()
+
+or 'm18.py station --port COM5 --metrics-port 9118'.
+"""
+import collections
+import datetime
+import http.server
+import json
+import threading
+
+# Upper bounds of the latency histogram buckets (seconds)
+BUCKETS = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+
+def label(value):
+    """ Escape a Prometheus label value """
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+class Metrics:
+    """
+    window    - number of recent syncs and probes per port used for the failure rate
+    threshold - failure rate above which a port is quarantined
+    min_syncs - syncs needed before a port can be quarantined
+    """
+    def __init__(self, buckets=BUCKETS, window=20, threshold=0.5, min_syncs=5):
+        self.buckets = tuple(buckets)
+        self.window = window
+        self.threshold = threshold
+        self.min_syncs = min_syncs
+        self.lock = threading.Lock()
+        self.ops = collections.Counter()   # (port, op, "ok"/"fail") -> count
+        self.histograms = {}               # (port, op) -> [bucket counts..., sum, count]
+        self.syncs = {}                    # port -> deque of recent sync results
+        self.quarantine = {}               # port -> time it was quarantined
+        self.sessions = []                 # attached M18 objects, for rx errors
+
+    def attach(self, m):
+        """ Report the operations of M18 session 'm' to these metrics """
+        m.metrics = self
+        with self.lock:
+            self.sessions.append(m)
+
+    def observe(self, port, op, seconds, ok):
+        """ Record one operation. Called by M18 """
+        with self.lock:
+            self.ops[(port, op, "ok" if ok else "fail")] += 1
+            h = self.histograms.get((port, op))
+            if h is None:
+                h = self.histograms[(port, op)] = [0] * (len(self.buckets) + 2)
+            for i, bound in enumerate(self.buckets):
+                if seconds <= bound:
+                    h[i] += 1
+                    break
+            h[-2] += seconds
+            h[-1] += 1
+
+            if op in ("sync", "probe"):
+                recent = self.syncs.setdefault(port, collections.deque(maxlen=self.window))
+                recent.append(ok)
+                if ( port not in self.quarantine and len(recent) >= self.min_syncs
+                        and recent.count(False) / len(recent) > self.threshold ):
+                    self.quarantine[port] = datetime.datetime.now()
+
+    def quarantined(self, port):
+        with self.lock:
+            return port in self.quarantine
+
+    def release(self, port):
+        """ Take a port out of quarantine (e.g. after replacing the cable) """
+        with self.lock:
+            self.quarantine.pop(port, None)
+            self.syncs.pop(port, None)
+
+    def sync_failure_rate(self, port):
+        recent = self.syncs.get(port)
+        return recent.count(False) / len(recent) if recent else None
+
+    def snapshot(self):
+        """ All metrics as a dict json can serialise """
+        with self.lock:
+            ports = {}
+            for (port, op, result), n in self.ops.items():
+                entry = ports.setdefault(str(port), {}).setdefault(op, {"ok": 0, "fail": 0})
+                entry[result] = n
+            for (port, op), h in self.histograms.items():
+                entry = ports[str(port)][op]
+                entry["seconds"] = h[-2]
+                entry["buckets"] = dict(zip([str(b) for b in self.buckets], h[:-2]))
+            return {
+                "time": datetime.datetime.now().isoformat(),
+                "ports": ports,
+                "rx_errors": {str(m.name): dict(m.rx.errors) for m in self.sessions},
+                "pipeline_fallbacks": {str(m.name): m.pipeline_fallbacks for m in self.sessions},
+                "sync_failure_rate": {str(port): self.sync_failure_rate(port) for port in self.syncs},
+                "quarantined": {str(port): t.isoformat() for port, t in self.quarantine.items()},
+            }
+
+    def prometheus(self):
+        """ All metrics in the Prometheus text exposition format """
+        lines = []
+        with self.lock:
+            lines.append("# HELP m18_operations_total Operations by port, operation and result")
+            lines.append("# TYPE m18_operations_total counter")
+            for (port, op, result), n in sorted(self.ops.items(), key=str):
+                lines.append(f'm18_operations_total{{port="{label(port)}",op="{label(op)}",'
+                             f'result="{result}"}} {n}')
+
+            lines.append("# HELP m18_operation_seconds Operation latency")
+            lines.append("# TYPE m18_operation_seconds histogram")
+            for (port, op), h in sorted(self.histograms.items(), key=str):
+                labels = f'port="{label(port)}",op="{label(op)}"'
+                total = 0
+                for bound, n in zip(self.buckets, h):
+                    total += n
+                    lines.append(f'm18_operation_seconds_bucket{{{labels},le="{bound}"}} {total}')
+                lines.append(f'm18_operation_seconds_bucket{{{labels},le="+Inf"}} {h[-1]}')
+                lines.append(f'm18_operation_seconds_sum{{{labels}}} {h[-2]}')
+                lines.append(f'm18_operation_seconds_count{{{labels}}} {h[-1]}')
+
+            lines.append("# HELP m18_rx_errors_total Frame parser errors by kind")
+            lines.append("# TYPE m18_rx_errors_total counter")
+            for m in self.sessions:
+                for kind, n in sorted(m.rx.errors.items()):
+                    lines.append(f'm18_rx_errors_total{{port="{label(m.name)}",kind="{label(kind)}"}} {n}')
+            lines.append("# HELP m18_pipeline_fallbacks_total Pipelined reads that fell back to stop-and-wait")
+            lines.append("# TYPE m18_pipeline_fallbacks_total counter")
+            for m in self.sessions:
+                lines.append(f'm18_pipeline_fallbacks_total{{port="{label(m.name)}"}} {m.pipeline_fallbacks}')
+
+            lines.append("# HELP m18_sync_failure_rate Failed fraction of the recent syncs")
+            lines.append("# TYPE m18_sync_failure_rate gauge")
+            for port in sorted(self.syncs, key=str):
+                lines.append(f'm18_sync_failure_rate{{port="{label(port)}"}} {self.sync_failure_rate(port)}')
+            lines.append("# HELP m18_quarantined 1 if the adapter is quarantined")
+            lines.append("# TYPE m18_quarantined gauge")
+            ports = set(self.syncs) | {m.name for m in self.sessions}
+            for port in sorted(ports, key=str):
+                lines.append(f'm18_quarantined{{port="{label(port)}"}} {int(port in self.quarantine)}')
+        return "\n".join(lines) + "\n"
+
+    def serve(self, port=9118, host="127.0.0.1"):
+        """
+        Serve prometheus() over HTTP from a background thread.
+        Returns the server; call shutdown() on it to stop
+        """
+        metrics = self
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            def do_GET(self):
+                body = metrics.prometheus().encode('utf-8')
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass # don't print every scrape
+
+        server = http.server.ThreadingHTTPServer((host, port), Handler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        return server
+
+    def dump_every(self, path, interval=60.0):
+        """
+        Append snapshot() as a line of JSON to 'path' every 'interval'
+        seconds from a background thread. Returns a function that stops it,
+        after writing a last line
+        """
+        event = threading.Event()
+
+        def run():
+            while True:
+                stopping = event.wait(interval)
+                with open(path, "a") as f:
+                    f.write(json.dumps(self.snapshot()) + "\n")
+                if stopping:
+                    return
+
+        thread = threading.Thread(target=run, daemon=True)
+        thread.start()
+
+        def stop():
+            event.set()
+            thread.join()
+        return stop
@@ -0,0 +1,306 @@
+"""
+Compact storage for time series of register values, e.g. cell voltages and
+temperatures from 'm18.py monitor --record', or keepalive responses
+recorded by M18.simulate_for().
+
+Samples are integers (store fractional values with a per-channel scale,
+e.g. temperature * 100). They are written in chunks of up to 'chunk_size'
+samples. Each chunk stores timestamps (ms) and each channel as zigzag
+varint deltas from the previous sample, so slowly changing values take
+about one byte per channel per sample.
+
+Every chunk starts with a small header holding its time range and the
+min, max and sum of each channel. A reader only decodes the headers to
+build its index, so finding a time range or downsampling a long recording
+only decodes the chunks it has to.
+
+File layout:
+    b"M18S" version(1)
+    varint channel count, then for each channel: varint name length,
+        name (utf-8), varint scale
+    chunks, each:
+        0xC1, varint header length, varint body length
+        header: varint count, zz t_first, varint t_last - t_first,
+                for each channel: zz min, varint max - min, zz sum
+        body:   zz time deltas (count - 1),
+                for each channel: zz first value, zz deltas (count - 1)
+
+(zz = zigzag varint, so small negative deltas stay small)
+"""
+import datetime
+import os
+from typing import NamedTuple
+
+MAGIC = b"M18S"
+VERSION = 1
+CHUNK_MARK = 0xC1
+
+
+def write_varint(out, n):
+    while n >= 0x80:
+        out.append((n & 0x7F) | 0x80)
+        n >>= 7
+    out.append(n)
+
+
+def write_zigzag(out, n):
+    write_varint(out, n << 1 if n >= 0 else (-n << 1) - 1)
+
+
+def read_varint(buf, pos):
+    """ Returns (value, new position) """
+    n = 0
+    shift = 0
+    while True:
+        b = buf[pos]
+        pos += 1
+        n |= (b & 0x7F) << shift
+        if b < 0x80:
+            return n, pos
+        shift += 7
+
+
+def read_zigzag(buf, pos):
+    n, pos = read_varint(buf, pos)
+    return (n >> 1) ^ -(n & 1), pos
+
+
+def to_ms(t):
+    """ datetime or seconds since the epoch -> integer ms since the epoch """
+    if isinstance(t, datetime.datetime):
+        t = t.timestamp()
+    return round(t * 1000)
+
+
+class Chunk(NamedTuple):
+    """ Index entry for one chunk, built from its header """
+    offset: int     # file offset of the body
+    length: int     # body length
+    count: int
+    t_first: int    # ms
+    t_last: int     # ms
+    mins: list
+    maxs: list
+    sums: list
+
+
+class SeriesWriter:
+    """
+    Append samples to a series file. If the file already exists its
+    channels must match and new chunks are appended to it.
+
+        with SeriesWriter("pack.m18s", ["cell1", "temp"], [1, 100]) as w:
+            w.append(datetime.datetime.now(), [3950, 25.5])
+    """
+    def __init__(self, path, channels, scales=None, chunk_size=256):
+        self.channels = list(channels)
+        self.scales = list(scales) if scales else [1] * len(self.channels)
+        self.chunk_size = chunk_size
+        self.times = []
+        self.values = [[] for _ in self.channels]
+
+        if os.path.exists(path) and os.path.getsize(path) > 0:
+            reader = SeriesReader(path)
+            if reader.channels != self.channels or reader.scales != self.scales:
+                raise ValueError(f"{path} has channels {reader.channels} {reader.scales}, "
+                                 f"not {self.channels} {self.scales}")
+            self.file = open(path, "ab")
+        else:
+            self.file = open(path, "wb")
+            header = bytearray(MAGIC)
+            header.append(VERSION)
+            write_varint(header, len(self.channels))
+            for name, scale in zip(self.channels, self.scales):
+                encoded = name.encode('utf-8')
+                write_varint(header, len(encoded))
+                header += encoded
+                write_varint(header, scale)
+            self.file.write(header)
+
+    def append(self, t, values):
+        """ Add one sample. 't' is a datetime or seconds since the epoch """
+        if len(values) != len(self.channels):
+            raise ValueError(f"Expected {len(self.channels)} values, got {len(values)}")
+        self.times.append(to_ms(t))
+        for column, value, scale in zip(self.values, values, self.scales):
+            column.append(round(value * scale))
+        if len(self.times) >= self.chunk_size:
+            self.flush()
+
+    def flush(self):
+        """ Write buffered samples as a chunk """
+        if not self.times:
+            return
+        times = self.times
+        header = bytearray()
+        write_varint(header, len(times))
+        write_zigzag(header, times[0])
+        write_varint(header, times[-1] - times[0])
+        body = bytearray()
+        for prev, t in zip(times, times[1:]):
+            write_zigzag(body, t - prev)
+        for column in self.values:
+            lo = min(column)
+            write_zigzag(header, lo)
+            write_varint(header, max(column) - lo)
+            write_zigzag(header, sum(column))
+            write_zigzag(body, column[0])
+            for prev, v in zip(column, column[1:]):
+                write_zigzag(body, v - prev)
+
+        chunk = bytearray([CHUNK_MARK])
+        write_varint(chunk, len(header))
+        write_varint(chunk, len(body))
+        self.file.write(chunk + header + body)
+        self.file.flush()
+        self.times = []
+        self.values = [[] for _ in self.channels]
+
+    def close(self):
+        self.flush()
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class SeriesReader:
+    """
+    Read a series file. Opening it only reads the chunk headers; samples are
+    decoded per chunk when a query needs them.
+
+    Times given to and returned from queries are datetimes (UTC) or seconds
+    since the epoch; values are scaled back to floats when the channel
+    scale is not 1.
+    """
+    def __init__(self, path):
+        with open(path, "rb") as f:
+            self.data = f.read()
+        buf = self.data
+        if buf[:4] != MAGIC:
+            raise ValueError(f"{path} is not a series file")
+        if buf[4] != VERSION:
+            raise ValueError(f"{path} has unsupported version {buf[4]}")
+        pos = 5
+        count, pos = read_varint(buf, pos)
+        self.channels = []
+        self.scales = []
+        for _ in range(count):
+            length, pos = read_varint(buf, pos)
+            self.channels.append(buf[pos:pos + length].decode('utf-8'))
+            pos += length
+            scale, pos = read_varint(buf, pos)
+            self.scales.append(scale)
+
+        self.chunks = []
+        while pos < len(buf):
+            if buf[pos] != CHUNK_MARK:
+                raise ValueError(f"{path}: bad chunk at offset {pos}")
+            header_len, pos = read_varint(buf, pos + 1)
+            body_len, pos = read_varint(buf, pos)
+            body = pos + header_len
+            if body + body_len > len(buf):
+                break # truncated last chunk (writer was killed)
+            n, pos = read_varint(buf, pos)
+            t_first, pos = read_zigzag(buf, pos)
+            span, pos = read_varint(buf, pos)
+            mins, maxs, sums = [], [], []
+            for _ in self.channels:
+                lo, pos = read_zigzag(buf, pos)
+                rng, pos = read_varint(buf, pos)
+                total, pos = read_zigzag(buf, pos)
+                mins.append(lo)
+                maxs.append(lo + rng)
+                sums.append(total)
+            self.chunks.append(Chunk(body, body_len, n, t_first, t_first + span, mins, maxs, sums))
+            pos = body + body_len
+
+    def __len__(self):
+        return sum(c.count for c in self.chunks)
+
+    def _scale(self, values):
+        return [v / s if s != 1 else v for v, s in zip(values, self.scales)]
+
+    def decode(self, chunk):
+        """ Decode a chunk into (times in ms, [column per channel]) of raw integers """
+        buf = self.data
+        pos = chunk.offset
+        times = [chunk.t_first]
+        t = chunk.t_first
+        for _ in range(chunk.count - 1):
+            d, pos = read_zigzag(buf, pos)
+            t += d
+            times.append(t)
+        columns = []
+        for _ in self.channels:
+            v, pos = read_zigzag(buf, pos)
+            column = [v]
+            for _ in range(chunk.count - 1):
+                d, pos = read_zigzag(buf, pos)
+                v += d
+                column.append(v)
+            columns.append(column)
+        return times, columns
+
+    def _range(self, start, end):
+        lo = to_ms(start) if start is not None else None
+        hi = to_ms(end) if end is not None else None
+        chunks = [c for c in self.chunks
+                  if (lo is None or c.t_last >= lo) and (hi is None or c.t_first < hi)]
+        return lo, hi, chunks
+
+    def read(self, start=None, end=None):
+        """ Yield (datetime, values) for samples with start <= time < end """
+        lo, hi, chunks = self._range(start, end)
+        for chunk in chunks:
+            times, columns = self.decode(chunk)
+            for i, t in enumerate(times):
+                if (lo is not None and t < lo) or (hi is not None and t >= hi):
+                    continue
+                yield (datetime.datetime.fromtimestamp(t / 1000, tz=datetime.UTC),
+                       self._scale([column[i] for column in columns]))
+
+    def downsample(self, step, start=None, end=None):
+        """
+        Summarise samples in buckets of 'step' seconds. Returns a list of
+        (bucket start datetime, count, mins, maxs, means). Chunks that lie
+        entirely inside one bucket are summarised from their header without
+        being decoded.
+        """
+        step_ms = to_ms(step)
+        lo, hi, chunks = self._range(start, end)
+        buckets = {}
+
+        def add(key, count, mins, maxs, sums):
+            b = buckets.get(key)
+            if b is None:
+                buckets[key] = [count, list(mins), list(maxs), list(sums)]
+                return
+            b[0] += count
+            b[1] = [min(x, y) for x, y in zip(b[1], mins)]
+            b[2] = [max(x, y) for x, y in zip(b[2], maxs)]
+            b[3] = [x + y for x, y in zip(b[3], sums)]
+
+        for chunk in chunks:
+            key = chunk.t_first // step_ms
+            inside = (lo is None or chunk.t_first >= lo) and (hi is None or chunk.t_last < hi)
+            if inside and chunk.t_last // step_ms == key:
+                add(key, chunk.count, chunk.mins, chunk.maxs, chunk.sums)
+                continue
+            times, columns = self.decode(chunk)
+            for i, t in enumerate(times):
+                if (lo is not None and t < lo) or (hi is not None and t >= hi):
+                    continue
+                values = [column[i] for column in columns]
+                add(t // step_ms, 1, values, values, values)
+
+        out = []
+        for key in sorted(buckets):
+            count, mins, maxs, sums = buckets[key]
+            out.append((datetime.datetime.fromtimestamp(key * step_ms / 1000, tz=datetime.UTC), count,
+                        self._scale(mins), self._scale(maxs),
+                        [s / count / scale for s, scale in zip(sums, self.scales)]))
+        return out
@@ -0,0 +1,334 @@
+"""
+Simulated M18 battery for testing and benchmarking without hardware.
+
+SimulatedBattery stands in for the serial.Serial object used by M18, so a
+session can be run with:
+
+    import m18, m18_sim
+    m = m18.M18(m18_sim.SimulatedBattery())
+    m.health()
+
+Bytes are timed as they would be on the wire (1 start bit, 8 data bits and
+2 stop bits at the port's baudrate) plus a turnaround delay in the battery
+before each response. With realtime=True (the default) reads block for as
+long as real hardware would. With realtime=False a virtual clock is used so
+nothing sleeps, but 'wire_time' still accumulates the modelled time.
+
+The command and response framing follows what m18.py sends and expects:
+    [cmd, acc, n, payload (n bytes), checksum (2 bytes, big endian)]
+Reads (0x01) are answered with 0x81, unknown addresses or bad checksums with
+the 2-byte error frame [0x82, code]. The responses to the charger commands
+(0x55, 0x60, 0x61, 0x62) are made up; only their lengths match m18.py.
+"""
+import collections
+import datetime
+import random
+import time
+
+import m18
+
+BITS_PER_BYTE = 11 # start + 8 data + 2 stop
+
+# J2 held high for this long without a sync counts as a dumb charge (0x901E)
+DUMB_CHARGE_TIME = 0.48
+
+
+def reverse_bits(byte):
+    return int(f"{byte:08b}"[::-1], 2)
+
+
+def checksum(payload):
+    return sum(payload) & 0xFFFF
+
+
+def frame(header, acc, payload):
+    """ Build an LSB-first response frame including checksum """
+    msg = bytes([header, acc, len(payload)]) + bytes(payload)
+    return msg + checksum(msg).to_bytes(2, 'big')
+
+
+def default_image(seed=0):
+    """
+    Return a plausible register image {addr: bytes} for a used 6Ah HO pack.
+    Registers that are not set explicitly get small pseudo-random values.
+    """
+    rng = random.Random(seed)
+
+    def u(value, length):
+        return int(value).to_bytes(length, 'big')
+
+    def date(*args):
+        return u(datetime.datetime(*args, tzinfo=datetime.UTC).timestamp(), 4)
+
+    image = {}
+    for reg in m18.register_map.registers:
+        image[reg.addr] = bytes(rng.randrange(0, 40) for _ in range(reg.length))
+
+    image.update({
+        0x0000: u(390, 2),
+        0x0002: u(0, 2),
+        0x0004: u(106, 2) + u(123456 + seed, 3),
+        0x0011: date(2021, 3, 1),
+        0x0015: date(2021, 4, 2),
+        0x0019: date(2025, 5, 20),
+        0x0023: b"-" * 20,
+        0x0037: date(2025, 6, 1, 12, 0, 0),
+        0x0069: u(2, 2),
+        0x007B: u(0, 1),
+        0x400A: b"".join(u(v, 2) for v in (3950, 3948, 3952, 3949, 3951)),
+        0x4014: u(0x01C0, 2),
+        0x401F: bytes([25, 128]),
+        0x9000: date(2021, 4, 2),
+        0x9004: date(2025, 5, 28),
+        0x9008: date(2025, 5, 20),
+        0x900C: u(0, 4),
+        0x9010: u(1500, 2),
+        0x9012: u(4320000, 4),
+        0x9016: u(77760000, 4),
+        0x901A: u(230, 4),
+        0x901E: u(3, 2),
+        0x9020: u(220, 2),
+        0x9022: u(200, 2),
+        0x9024: u(800000, 4),
+        0x9028: u(300000, 4),
+        0x902C: u(0, 2),
+        0x902E: u(1, 2),
+        0x9030: u(40, 2),
+        0x9032: u(2, 2),
+        0x9034: u(5, 2),
+        0x9036: u(30, 2),
+        0x9038: u(4, 2),
+    })
+    # Discharge histogram 10-20A ... 200A+, mostly at low current
+    for i, addr in enumerate(range(0x903A, 0x9062, 2)):
+        image[addr] = u(30000 >> i, 2)
+    return image
+
+
+class SimulatedBattery:
+    """
+    Serial-port-like object that behaves like an M18 battery on the other
+    end of the adapter. See the module docstring.
+    """
+    def __init__(self, image=None, baudrate=4800, timeout=0.8, stopbits=2,
+                 turnaround=0.005, realtime=True, bauds=(4800,), connected=True,
+                 garble=0.0, drop=(), seed=0):
+        self.memory = bytearray(0x10000)
+        self.readable = set()
+        for addr, length in m18.register_map.read_plan:
+            self.readable.update(range(addr, addr + max(length, 1)))
+        for reg in m18.register_map.registers:
+            self.readable.update(range(reg.addr, reg.addr + reg.length))
+        self.load(default_image() if image is None else image)
+
+        self.baudrate = baudrate
+        self.timeout = timeout
+        self.stopbits = stopbits
+        self.turnaround = turnaround
+        self.realtime = realtime
+        self.bauds = set(bauds)   # baudrates the battery can lock on to
+        self.connected = connected
+        self.garble = garble      # chance of a response having a byte dropped or corrupted
+        self.drop = set(drop)     # numbers (1 = first) of read responses that are lost entirely
+        self.read_responses = 0
+        self.rng = random.Random(seed)
+        self.is_open = True
+
+        self.wire_time = 0.0      # modelled seconds spent on the wire
+        self.waited = 0.0         # seconds read() spent waiting for bytes
+        self.bytes_tx = 0         # adapter -> battery
+        self.bytes_rx = 0         # battery -> adapter
+        self.commands = collections.Counter()
+
+        self._clock = 0.0
+        self._rx = collections.deque() # (ready_time, msb byte)
+        self._host_free = 0.0     # time the adapter TX line is next free
+        self._batt_free = 0.0     # time the battery TX line is next free
+        self._frame = bytearray()
+        self._synced = False
+        self._locked_baud = None
+        self._high_since = None
+        self._break = True
+        self._dtr = True
+
+    # ---- register image ----
+
+    def load(self, image):
+        for addr, data in image.items():
+            self.memory[addr:addr + len(data)] = data
+
+    def set_register(self, addr, data):
+        self.memory[addr:addr + len(data)] = data
+
+    def register(self, addr, length):
+        return bytes(self.memory[addr:addr + length])
+
+    # ---- time ----
+
+    def _now(self):
+        return time.monotonic() if self.realtime else self._clock
+
+    def _wait_until(self, t):
+        if self.realtime:
+            delay = t - time.monotonic()
+            if delay > 0:
+                self.waited += delay
+                time.sleep(delay)
+        elif t > self._clock:
+            self.waited += t - self._clock
+            self._clock = t
+
+    def byte_time(self):
+        return BITS_PER_BYTE / self.baudrate
+
+    # ---- J2 line (break / DTR) ----
+
+    def _line_changed(self):
+        high = not (self._break or self._dtr)
+        now = self._now()
+        if high and self._high_since is None:
+            self._high_since = now
+            self._synced = False
+            self._locked_baud = None
+            self._frame.clear()
+        elif not high and self._high_since is not None:
+            self._check_dumb_charge(now)
+            self._high_since = None
+            self._synced = False
+
+    def _check_dumb_charge(self, now):
+        if ( self.connected and not self._synced and self._high_since is not None
+                and (now - self._high_since) >= DUMB_CHARGE_TIME ):
+            count = int.from_bytes(self.register(0x901E, 2), 'big')
+            self.set_register(0x901E, (count + 1).to_bytes(2, 'big'))
+
+    @property
+    def break_condition(self):
+        return self._break
+
+    @break_condition.setter
+    def break_condition(self, value):
+        self._break = bool(value)
+        self._line_changed()
+
+    @property
+    def dtr(self):
+        return self._dtr
+
+    @dtr.setter
+    def dtr(self, value):
+        self._dtr = bool(value)
+        self._line_changed()
+
+    # ---- serial.Serial interface ----
+
+    @property
+    def in_waiting(self):
+        now = self._now()
+        return sum(1 for t, _ in self._rx if t <= now)
+
+    def reset_input_buffer(self):
+        now = self._now()
+        while self._rx and self._rx[0][0] <= now:
+            self._rx.popleft()
+
+    def flush(self):
+        pass
+
+    def close(self):
+        self.is_open = False
+
+    def write(self, data):
+        bt = self.byte_time()
+        t = max(self._now(), self._host_free)
+        for b in data:
+            t += bt
+            self.bytes_tx += 1
+            self.wire_time += bt
+            self._receive(reverse_bits(b), t)
+        self._host_free = t
+        return len(data)
+
+    def read(self, size=1):
+        start = self._now()
+        deadline = start + (self.timeout if self.timeout is not None else 1e9)
+        out = bytearray()
+        while len(out) < size:
+            if not self._rx or self._rx[0][0] > deadline:
+                self._wait_until(deadline)
+                break
+            ready, b = self._rx.popleft()
+            self._wait_until(ready)
+            out.append(b)
+        return bytes(out)
+
+    # ---- battery side ----
+
+    def _respond(self, lsb, t):
+        bt = self.byte_time()
+        if self.garble and self.rng.random() < self.garble:
+            lsb = list(lsb)
+            i = self.rng.randrange(len(lsb))
+            if self.rng.random() < 0.5:
+                del lsb[i]
+            else:
+                lsb[i] ^= 0x5A
+        t = max(t + self.turnaround, self._batt_free)
+        for b in lsb:
+            t += bt
+            self.bytes_rx += 1
+            self.wire_time += bt
+            self._rx.append((t, reverse_bits(b)))
+        self._batt_free = t
+
+    def _receive(self, byte, t):
+        high = not (self._break or self._dtr)
+        if not (self.connected and high):
+            return
+        if not self._synced:
+            # Auto-baud: the battery locks on to the sync byte if it can
+            if byte == m18.M18.SYNC_BYTE and self.baudrate in self.bauds:
+                self._check_dumb_charge(t)
+                self._synced = True
+                self._locked_baud = self.baudrate
+                self._respond([m18.M18.SYNC_BYTE], t)
+            return
+        if self.baudrate != self._locked_baud:
+            return # garbage at the wrong rate
+        self._frame.append(byte)
+        if len(self._frame) >= 3 and len(self._frame) == 3 + self._frame[2] + 2:
+            msg = bytes(self._frame)
+            self._frame.clear()
+            self._command(msg, t)
+
+    def _command(self, msg, t):
+        body, cksum = msg[:-2], int.from_bytes(msg[-2:], 'big')
+        cmd, acc = body[0], body[1]
+        self.commands[cmd] += 1
+        if checksum(body) != cksum:
+            self._respond([0x82, 0x01], t)
+            return
+        match cmd:
+            case 0x01 if acc == 0x05:
+                # wcmd(): write one byte
+                addr = (body[3] << 8) | body[4]
+                self.memory[addr] = body[5]
+                self._respond([0x81, 0x05], t)
+            case 0x01:
+                addr = (body[3] << 8) | body[4]
+                length = body[5]
+                if all(a in self.readable for a in range(addr, addr + max(length, 1))):
+                    self.read_responses += 1
+                    if self.read_responses in self.drop:
+                        return
+                    self._respond(frame(0x81, acc, self.register(addr, length)), t)
+                else:
+                    self._respond([0x82, 0x02], t)
+            case 0x60:
+                self._respond(frame(0xE0, acc, b""), t)
+            case 0x61 | 0x55:
+                self._respond(frame(cmd | 0x80, acc, bytes(3)), t)
+            case 0x62:
+                self._respond(frame(0xE2, acc, bytes(4)), t)
+            case _:
+                self._respond([0x82, 0x03], t)
@@ -0,0 +1,252 @@
+"""
+Deduplicated store for register snapshots.
+
+Each image is split into chunks along the reads of the read plan
+(data_matrix), and every distinct chunk is stored once in an SQLite
+database, addressed by its hash and reference counted. A snapshot is its
+time, port, serial and the list of its chunks. Most of an image does not
+change between reads of a pack (serial, dates, the 0x0000-0x007B block,
+histogram buckets of an idle pack), so repeated reads cost little more
+than the list.
+
+Images are stored exactly: every register in a snapshot is returned with
+the same bytes, and registers that were not read stay missing.
+
+Usage:
+    python m18_store.py fleet.db import snapshots.ndjson    # 'm18.py dump' output
+    python m18_store.py fleet.db export > snapshots.ndjson  # --serial N for one pack
+    python m18_store.py fleet.db list
+    python m18_store.py fleet.db delete 12 13
+    python m18_store.py fleet.db stats
+    python m18_store.py fleet.db backup copy.db
+
+From Python:
+    with m18_store.SnapshotStore("fleet.db") as store:
+        id = store.add(m.read_image(), port="COM5")
+        image = store.get(id)["image"]
+"""
+import argparse
+import bisect
+import datetime
+import hashlib
+import sqlite3
+import struct
+import sys
+
+import m18
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS chunks (
+    id INTEGER PRIMARY KEY,
+    hash BLOB UNIQUE NOT NULL,
+    data BLOB NOT NULL,
+    refs INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS snapshots (
+    id INTEGER PRIMARY KEY,
+    serial INTEGER,
+    time TEXT,
+    port TEXT,
+    chunks BLOB NOT NULL   -- chunk ids, 4 bytes each, big endian
+);
+CREATE INDEX IF NOT EXISTS snapshots_serial ON snapshots (serial, time);
+"""
+
+# Start address of every read in the plan, to find the chunk of an address
+plan_starts = [addr for addr, length in m18.register_map.read_plan]
+
+
+def chunk_index(addr):
+    """ Index of the read plan entry containing 'addr', or len(read_plan) for anything else """
+    n = bisect.bisect_right(plan_starts, addr) - 1
+    if n >= 0:
+        start, length = m18.register_map.read_plan[n]
+        if addr < start + max(length, 1):
+            return n
+    return len(plan_starts)
+
+
+def split_image(image):
+    """
+    Split an image {addr: bytes} into chunk blobs, one per read plan entry
+    that has registers in the image. A blob is the registers it contains,
+    each as addr (2 bytes), length (1 byte), data.
+    """
+    groups = {}
+    for addr in sorted(image):
+        data = bytes(image[addr])
+        groups.setdefault(chunk_index(addr), []).append(struct.pack('>HB', addr, len(data)) + data)
+    return [b"".join(groups[n]) for n in sorted(groups)]
+
+
+def join_chunks(blobs):
+    """ Inverse of split_image() """
+    image = {}
+    for blob in blobs:
+        pos = 0
+        while pos < len(blob):
+            addr, length = struct.unpack_from('>HB', blob, pos)
+            image[addr] = blob[pos + 3:pos + 3 + length]
+            pos += 3 + length
+    return image
+
+
+def chunk_hash(blob):
+    return hashlib.blake2b(blob, digest_size=16).digest()
+
+
+class SnapshotStore:
+    """ See the module docstring """
+    def __init__(self, path):
+        self.db = sqlite3.connect(path)
+        self.db.executescript(SCHEMA)
+
+    def close(self):
+        self.db.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def add(self, image, time=None, port=None, commit=True):
+        """ Store an image. 'time' is a datetime or ISO 8601 string. Returns the snapshot id """
+        if time is None:
+            time = datetime.datetime.now()
+        if isinstance(time, datetime.datetime):
+            time = time.isoformat()
+        ids = []
+        for blob in split_image(image):
+            h = chunk_hash(blob)
+            row = self.db.execute("SELECT id FROM chunks WHERE hash = ?", (h,)).fetchone()
+            if row:
+                self.db.execute("UPDATE chunks SET refs = refs + 1 WHERE id = ?", row)
+                ids.append(row[0])
+            else:
+                cur = self.db.execute("INSERT INTO chunks (hash, data, refs) VALUES (?, ?, 1)", (h, blob))
+                ids.append(cur.lastrowid)
+        cur = self.db.execute(
+            "INSERT INTO snapshots (serial, time, port, chunks) VALUES (?, ?, ?, ?)",
+            (m18.image_serial(image), time, port, struct.pack(f'>{len(ids)}I', *ids)))
+        if commit:
+            self.db.commit()
+        return cur.lastrowid
+
+    def get(self, id):
+        """ Return {"id", "serial", "time", "port", "image"}, or None if there is no such snapshot """
+        row = self.db.execute("SELECT id, serial, time, port, chunks FROM snapshots WHERE id = ?",
+                              (id,)).fetchone()
+        return self._snapshot(row) if row else None
+
+    def _snapshot(self, row):
+        id, serial, time, port, chunks = row
+        ids = struct.unpack(f'>{len(chunks) // 4}I', chunks)
+        data = dict(self.db.execute(
+            f"SELECT id, data FROM chunks WHERE id IN ({','.join('?' * len(ids))})", ids))
+        return {"id": id, "serial": serial, "time": time, "port": port,
+                "image": join_chunks(data[i] for i in ids)}
+
+    def snapshots(self, serial=None):
+        """ Yield every snapshot (of one pack if 'serial' is given) in time order """
+        query = "SELECT id, serial, time, port, chunks FROM snapshots"
+        params = ()
+        if serial is not None:
+            query += " WHERE serial = ?"
+            params = (serial,)
+        for row in self.db.execute(query + " ORDER BY serial, time, id", params).fetchall():
+            yield self._snapshot(row)
+
+    def entries(self, serial=None):
+        """ [(id, serial, time, port)] without reading the images """
+        query = "SELECT id, serial, time, port FROM snapshots"
+        params = ()
+        if serial is not None:
+            query += " WHERE serial = ?"
+            params = (serial,)
+        return self.db.execute(query + " ORDER BY serial, time, id", params).fetchall()
+
+    def delete(self, id):
+        """ Remove a snapshot and any chunks no other snapshot uses. Returns False if there is none """
+        row = self.db.execute("SELECT chunks FROM snapshots WHERE id = ?", (id,)).fetchone()
+        if row is None:
+            return False
+        ids = struct.unpack(f'>{len(row[0]) // 4}I', row[0])
+        self.db.executemany("UPDATE chunks SET refs = refs - 1 WHERE id = ?", [(i,) for i in ids])
+        self.db.execute("DELETE FROM chunks WHERE refs <= 0")
+        self.db.execute("DELETE FROM snapshots WHERE id = ?", (id,))
+        self.db.commit()
+        return True
+
+    def import_file(self, path):
+        """ Add every snapshot in a snapshot file. Returns the number added """
+        count = 0
+        for snap in m18.load_snapshots(path):
+            self.add(snap["image"], snap.get("time"), snap.get("port"), commit=False)
+            count += 1
+        self.db.commit()
+        return count
+
+    def stats(self):
+        snapshots, raw = self.db.execute(
+            "SELECT COUNT(*), COALESCE(SUM(LENGTH(chunks)), 0) FROM snapshots").fetchone()
+        chunks, data, refs = self.db.execute(
+            "SELECT COUNT(*), COALESCE(SUM(LENGTH(data)), 0), COALESCE(SUM(refs * LENGTH(data)), 0) FROM chunks"
+        ).fetchone()
+        return {
+            "snapshots": snapshots,
+            "chunks": chunks,
+            "image_bytes": refs,         # images as stored without deduplication
+            "stored_bytes": data + raw,  # chunk data plus chunk lists
+        }
+
+    def backup(self, path):
+        """ Copy the store to 'path' (consistent even while it is in use) """
+        target = sqlite3.connect(path)
+        with target:
+            self.db.backup(target)
+        target.close()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Deduplicated store for M18 register snapshots")
+    parser.add_argument('db', help="Store file (SQLite)")
+    commands = parser.add_subparsers(dest='command', required=True, metavar='COMMAND')
+    cmd = commands.add_parser('import', help="Add snapshots from files of 'm18.py dump' output")
+    cmd.add_argument('files', nargs='+')
+    cmd = commands.add_parser('export', help="Print snapshots as a snapshot file")
+    cmd.add_argument('--serial', type=int, help="Only this pack")
+    cmd = commands.add_parser('list', help="List snapshots")
+    cmd.add_argument('--serial', type=int, help="Only this pack")
+    cmd = commands.add_parser('delete', help="Delete snapshots")
+    cmd.add_argument('ids', type=int, nargs='+')
+    commands.add_parser('stats', help="Print storage statistics")
+    cmd = commands.add_parser('backup', help="Copy the store")
+    cmd.add_argument('target')
+    args = parser.parse_args(argv)
+
+    with SnapshotStore(args.db) as store:
+        match args.command:
+            case 'import':
+                for path in args.files:
+                    print(f"{path}: {store.import_file(path)} snapshots", file=sys.stderr)
+            case 'export':
+                for snap in store.snapshots(args.serial):
+                    m18.emit({"port": snap["port"], "time": snap["time"],
+                              "image": m18.image_to_json(snap["image"])})
+            case 'list':
+                for id, serial, time, port in store.entries(args.serial):
+                    print(f"{id:6d} {serial if serial is not None else '-':>8} {time} {port or ''}")
+            case 'delete':
+                for id in args.ids:
+                    if not store.delete(id):
+                        print(f"No snapshot {id}", file=sys.stderr)
+            case 'stats':
+                m18.emit(store.stats())
+            case 'backup':
+                store.backup(args.target)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())